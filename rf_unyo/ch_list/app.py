@@ -1,69 +1,111 @@
 import sys
+import time
+# --- 起動時間の計測 (--profile-startup で内訳を表示) ---
+STARTUP_T0 = time.perf_counter()
+PROFILE_STARTUP = "--profile-startup" in sys.argv
+startup_marks = []
+
+def mark_startup(phase):
+    startup_marks.append((phase, time.perf_counter()))
+
 import webbrowser
-from threading import Timer, Thread
+from threading import Timer, Thread, Event
 import signal
-from flask import Flask, render_template, request, session, jsonify, send_file
-import sqlite3
 from pathlib import Path
 import io
-import openpyxl
 import unicodedata
 import shutil
-import tempfile
 import os
-import csv
 from datetime import datetime, timedelta
-import webview
-import socket
-import time
-import base64
 import logging
+import atexit
+import queue
+from logging.handlers import TimedRotatingFileHandler, WatchedFileHandler, QueueHandler, QueueListener
+import uuid
+import json
+import base64
+import bisect
+import hashlib
+import functools
+import gzip
+import zlib
+from contextlib import contextmanager
+mark_startup("import: 標準ライブラリ")
+from flask import Flask, render_template, request, session, jsonify, send_file, g, url_for
+from werkzeug.serving import make_server
+mark_startup("import: flask")
+from db import ConnectionPool, ReferenceCache, data_signature
+from keep_store import KeepStore
+from metrics import Metrics, SLOW_QUERY_MS
+from search_cache import SearchCache, snapshot_ranking_matches
+from export_jobs import JobManager, JobQueueFull
+mark_startup("import: アプリ内モジュール")
+# 起動を速くするため、webview・excel_export・numpy (wsm_export / freq_planner) は
+# 使う箇所で読み込みます (ウィンドウ表示後に warm_up() で裏読み込み)。
+HEAVY_MODULES = ("excel_export", "wsm_export", "freq_planner")
 
 # --- ログ設定 (macOS標準の場所: ~/Library/Logs/RF_Unyo_System/ ) ---
-def setup_logging():
-    log_dir = Path.home() / "Library" / "Logs" / "RF_Unyo_System"
-    log_dir.mkdir(parents=True, exist_ok=True)
-    log_file = log_dir / "debug.log"
+# debug.log は日付が変わると debug.log.YYYY-MM-DD に切り替え、日付が LOG_RETENTION_DAYS 日より古いファイルは
+# 起動時と切り替え時に削除します (backupCount はファイル数の上限で、休日など起動しない日があると日数と合わないため使いません)。
+# ファイルへの書き込みは QueueListener の専用スレッドで行い、リクエスト処理側はキューに積むだけにします。
+# SIGTERM で自プロセスを終了する箇所では atexit が動かないため、先に stop_logging() でキューを書き出します。
+LOG_DIR = Path.home() / "Library" / "Logs" / "RF_Unyo_System"
+LOG_RETENTION_DAYS = 90
+# ヘッドレスモードのワーカープロセス (--listen-fd 付きで起動される) は切り替えを親プロセスに任せ、
+# 切り替え後のファイルを開き直すだけにします (複数プロセスが同時に切り替えるとログを失うため)。
+HEADLESS_WORKER = "--listen-fd" in sys.argv
 
-    # --- ログファイル内の古い行(3か月以上前)を削除する ---
-    if log_file.exists():
-        try:
-            cutoff_date = datetime.now() - timedelta(days=90)
-            cutoff_str = cutoff_date.strftime('%Y-%m-%d')
-            
-            new_lines = []
-            with open(log_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            
-            keep_this_entry = True
-            for line in lines:
-                if len(line) >= 10 and line[0:4].isdigit() and line[4] == '-' and line[7] == '-':
-                    if line[0:10] >= cutoff_str: keep_this_entry = True
-                    else: keep_this_entry = False
-                
-                if keep_this_entry: new_lines.append(line)
-            
-            with open(log_file, 'w', encoding='utf-8') as f:
-                f.writelines(new_lines)
-        except Exception as e:
-            print(f"Failed to clean up log entries: {e}")
+def prune_old_logs(today=None):
+    """切り替え済みのログ (debug.log.YYYY-MM-DD) のうち、日付が LOG_RETENTION_DAYS 日より古いものを削除する"""
+    cutoff = (today or datetime.now()).date() - timedelta(days=LOG_RETENTION_DAYS)
+    for path in LOG_DIR.glob("debug.log.*"):
+        try: day = datetime.strptime(path.name[len("debug.log."):], "%Y-%m-%d").date()
+        except ValueError: continue
+        if day < cutoff: path.unlink(missing_ok=True)
+
+class RetentionFileHandler(TimedRotatingFileHandler):
+    """日付が変わると切り替え、保存期間を過ぎたログを削除する"""
+    def doRollover(self):
+        super().doRollover()
+        prune_old_logs()
+
+log_listener = None
+
+def stop_logging():
+    """キューに残ったログを書き出してから書き込みスレッドを止める (何度呼んでもよい)"""
+    global log_listener
+    listener, log_listener = log_listener, None
+    if listener is not None: listener.stop()
+
+def setup_logging():
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    global log_file_handler, log_listener
+    if HEADLESS_WORKER:
+        file_handler = WatchedFileHandler(LOG_DIR / "debug.log", encoding='utf-8')
+    else:
+        file_handler = RetentionFileHandler(LOG_DIR / "debug.log", when="midnight", encoding='utf-8')
+        prune_old_logs()
+    log_file_handler = file_handler
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(stop_logging)
 
     # ロギングの初期化
-    logging.basicConfig(
-        filename=str(log_file),
-        level=logging.INFO,
-        format='%(asctime)s %(levelname)s: %(message)s',
-        encoding='utf-8'
-    )
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
     
     # Flask(Werkzeug)のアクセスログを抑制（重要ログのみ表示）
     werkzeug_log = logging.getLogger('werkzeug')
     werkzeug_log.setLevel(logging.ERROR)
     
-    logging.info("--- Application Started ---")
+    logging.info(f"--- Application Started (pid {os.getpid()}) ---" if HEADLESS_WORKER else "--- Application Started ---")
     return True
 
 setup_logging()
+mark_startup("ログ設定")
 
 # --- 保存用APIクラス ---
 class Api:
@@ -71,6 +113,7 @@ class Api:
         self.window = None
 
     def save_file(self, data_base64, default_filename):
+        import webview
         try:
             # 最新の書き方 (webview.FileDialog.SAVE) に修正
             file_path = self.window.create_file_dialog(
@@ -93,10 +136,16 @@ class Api:
 
     def export_log(self):
         try:
-            src = Path.home() / "Library" / "Logs" / "RF_Unyo_System" / "debug.log"
+            src = LOG_DIR / "debug.log"
             dst = Path.home() / "Desktop" / f"rf_unyo_debug_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
             if src.exists():
-                shutil.copy2(src, dst)
+                # 切り替え済みの過去ログ (debug.log.YYYY-MM-DD) を古い順に連結し、最後に当日分を付ける
+                with open(dst, 'wb') as out:
+                    for path in sorted(LOG_DIR.glob("debug.log.*")) + [src]:
+                        with open(path, 'rb') as f: shutil.copyfileobj(f, out)
+                # 実行時メトリクス (/metrics と同じ内容) を末尾に追記
+                with open(dst, 'a', encoding='utf-8') as f:
+                    f.write("\n--- Metrics ---\n" + json.dumps(metrics_snapshot(), ensure_ascii=False, indent=2) + "\n")
                 logging.info(f"Log exported to Desktop: {dst.name}")
                 return {"status": "success", "filename": dst.name}
             else:
@@ -113,13 +162,18 @@ def get_base_path():
     return Path(__file__).resolve().parent
 
 BASE_DIR = get_base_path()
-DB_PATH = BASE_DIR / "database.db"
+# 環境変数で差し替え可能 (benchmark.py が合成データのDBで計測する場合など)
+DB_PATH = Path(os.environ.get("RF_UNYO_DB_PATH") or BASE_DIR / "database.db")
+# キープリストはアプリ同梱のDBとは別に、ユーザー領域へ保存する
+KEEP_DB_PATH = Path(os.environ.get("RF_UNYO_KEEP_DB_PATH") or Path.home() / "Library" / "Application Support" / "RF_Unyo_System" / "keep_list.db")
 MASTER_XLSX = BASE_DIR / "masters" / "master.xlsx"
 
 app = Flask(__name__, 
             template_folder=str(BASE_DIR / "templates"),
             static_folder=str(BASE_DIR / "static"))
 app.secret_key = "rf_unyo_secret_key"
+# 日本語を \uXXXX にエスケープせず UTF-8 のまま返す (レスポンスが約半分になる)
+app.json.ensure_ascii = False
 
 # --- バージョン設定 ---
 APP_VERSION = "1.0.0"
@@ -134,33 +188,358 @@ def normalize_text(text):
     if text is None: return ""
     return unicodedata.normalize('NFKC', str(text)).lower()
 
+db = ConnectionPool(DB_PATH, normalize_text)
+
+# --- メトリクス (ルート別レイテンシ・SQL 実行時間。/metrics で参照) ---
+# スロークエリのしきい値 (ms) は環境変数 RF_UNYO_SLOW_QUERY_MS で変更可能
+metrics = Metrics(slow_query_ms=float(os.environ.get("RF_UNYO_SLOW_QUERY_MS") or SLOW_QUERY_MS))
+
+def metrics_snapshot():
+    return {**metrics.snapshot(), "search_cache": search_cache.stats()}
+
+@contextmanager
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.create_function("NORM", 1, normalize_text)
-    return conn
+    """読み取り用の接続をプールから借りる (with 文で使用)。実行した SQL の時間を metrics に記録する"""
+    with db.read() as conn:
+        tracer = metrics.sql_tracer()
+        conn.set_trace_callback(tracer)
+        try:
+            yield conn
+        finally:
+            conn.set_trace_callback(None)
+            tracer.finish()
+
+def get_write_connection():
+    """設定更新用の書き込み接続を借りる (with 文で使用。抜けると commit)"""
+    return db.write()
+
+# --- 参照テーブルのキャッシュ (tv_channels / devices) ---
+def load_reference_tables(conn):
+    devices = [dict(d) for d in conn.execute("SELECT * FROM devices").fetchall()]
+    tv_channels = [dict(c) for c in conn.execute("SELECT * FROM tv_channels").fetchall()]
+    for d in tv_channels:
+        if 'TVchannel' in d:
+            try: d['TVchannel'] = int(d['TVchannel'])
+            except: pass
+    return {"devices": devices, "tv_channels": tv_channels, "tv_ch_map": {c["TVchannel"]: c for c in tv_channels}}
+
+reference_cache = ReferenceCache(db, load_reference_tables)
+
+# --- 集計テーブルのキャッシュ (facet_*: init_db.py / update_db.py で構築) ---
+def load_facets(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='facet_pref'").fetchone(): return None
+    prefs = [dict(r) for r in conn.execute("SELECT pref, venue_count, indoor_count, outdoor_count FROM facet_pref ORDER BY sort_order, pref")]
+    cities = {}
+    for r in conn.execute("SELECT * FROM facet_city ORDER BY pref, venue_count DESC, city"):
+        cities.setdefault(r["pref"], []).append({k: r[k] for k in ("city", "venue_count", "indoor_count", "outdoor_count")})
+    channels, total = {}, {}
+    for r in conn.execute("SELECT pref, ch, free_count FROM facet_pref_channel ORDER BY pref, ch"):
+        channels.setdefault(r["pref"], {})[r["ch"]] = r["free_count"]
+        total[r["ch"]] = total.get(r["ch"], 0) + r["free_count"]
+    return {"prefectures": prefs, "cities": cities, "channels": channels, "total_channels": total}
+
+facet_cache = ReferenceCache(db, load_facets)
+
+# --- ブラウザ内検索用のスナップショット (search_snapshot: init_db.py / update_db.py で構築) ---
+# gzip 圧縮済みの JSON を /snapshot/venues.<digest>.json で配信します。digest は内容から決まるため
+# 同じ URL の内容は変わらず、ブラウザには長期間キャッシュさせます (DBが差し替えられると検索画面に渡す URL が変わる)。
+# ブラウザ側の bm25 (JS) が SQL と同じ並び順になるかを読み込み時に SNAPSHOT_CHECK_QUERIES で確かめ、
+# 一致しない場合 (SQLite の版で FTS5 の計算が変わった等) はスナップショットを配信せず /search で検索させます。
+SNAPSHOT_MAX_AGE = 365 * 24 * 3600
+SNAPSHOT_CHECK_QUERIES = ("ホール", "センター", "市民会館", "体育館", "東京都", "ーヨー")
+
+def load_search_snapshot(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='search_snapshot'").fetchone(): return None
+    row = conn.execute("SELECT digest, data FROM search_snapshot").fetchone()
+    if not row or not has_search_index(conn): return None
+    snapshot = json.loads(gzip.decompress(row["data"]))
+    if not snapshot_ranking_matches(conn, snapshot, FTS_WEIGHTS, SNAPSHOT_CHECK_QUERIES):
+        logging.warning("ブラウザ内検索の並び順が /search と一致しないため、スナップショットを配信しません")
+        return None
+    return {"digest": row["digest"], "data": row["data"]}
+
+snapshot_cache = ReferenceCache(db, load_search_snapshot)
+
+# --- 施設検索 ---
+SEARCH_LIMIT = 100
+# FTS5 の bm25 列重み (施設名 > 住所 > 都道府県名)
+FTS_WEIGHTS = (10.0, 5.0, 1.0)
+# 入力途中の検索語の結果キャッシュ (search_cache.py。RF_UNYO_SEARCH_CACHE_ENTRIES=0 で無効)
+search_cache = SearchCache(FTS_WEIGHTS, max_entries=int(os.environ.get("RF_UNYO_SEARCH_CACHE_ENTRIES") or 256))
+
+def has_search_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='venues_fts'").fetchone() is not None
+
+# --- チャンネル条件 (venues.ch_mask の bit (ch - 13) が 1 = そのCHが運用可能) ---
+CH_MIN, CH_MAX = 13, 53
+
+def channel_mask(channels):
+    mask = 0
+    for ch in channels:
+        if not CH_MIN <= ch <= CH_MAX: raise ValueError(f"channel out of range: {ch}")
+        mask |= 1 << (ch - CH_MIN)
+    return mask
+
+def band_mask(min_mhz, max_mhz):
+    """指定した周波数範囲 (MHz) に収まるCHのマスク"""
+    return channel_mask([ch for ch, r in reference_cache.get()["tv_ch_map"].items()
+                         if r["minfrequency"] >= min_mhz * 1000 and r["maxfrequency"] <= max_mhz * 1000])
+
+def free_count_sql(bmask):
+    """bmask 内の運用可能CH数を数える SQL 式 (SQLite にはビットカウント関数が無いため各ビットを加算)"""
+    return " + ".join(f"((v.ch_mask >> {i}) & 1)" for i in range(CH_MAX - CH_MIN + 1) if bmask >> i & 1) or "0"
+
+def channel_filter_match(ch_mask, ch_filter):
+    """free_count_sql を使った SQL の絞り込みと同じ判定を Python で行う"""
+    required, bmask, min_free = ch_filter
+    return ch_mask is not None and ch_mask & required == required and (ch_mask & bmask).bit_count() >= min_free
+
+def parse_channel_filter(args):
+    """検索引数からチャンネル条件 (必須CHマスク, 帯域マスク, 最低空きCH数) を作る。条件なしは None
+    - channels=27,36,44 : 指定CHがすべて運用可能
+    - min_free=10&band=470-714 : 帯域 (MHz) 内の運用可能CHが10以上 (band 省略時は 13〜53CH 全体)"""
+    channels = args.get("channels", "")
+    min_free = args.get("min_free", 0, type=int)
+    if not channels and min_free <= 0: return None
+    required = channel_mask([int(c) for c in channels.split(",") if c.strip()])
+    band = args.get("band", "")
+    if band:
+        lo, hi = (float(x) for x in band.split("-"))
+        bmask = band_mask(lo, hi)
+    else:
+        bmask = channel_mask(range(CH_MIN, CH_MAX + 1))
+    return required, bmask, min_free
+
+def parse_area_filter(args):
+    """検索引数から所在地の条件 (都道府県名, 市区町村名 or None) を作る。条件なしは None
+    - pref=東京都&city=北区 : /facets の市区町村別件数と同じ区分 (venue_area) で絞り込む (city= は「その他」)
+    - pref=東京都 : 都道府県のみ"""
+    pref = args.get("pref", "")
+    if not pref:
+        if "city" in args: raise ValueError("city を指定する場合は pref も指定してください")
+        return None
+    return pref, args.get("city")
+
+def has_area_table(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='venue_area'").fetchone() is not None
+
+# --- 検索結果の列 (view=summary: 一覧表示に使う列のみ / view=full: 全列) と キーセット方式のページ送り ---
+# 各検索は (並べ替えキー, 施設ID) の昇順に並ぶため、前のページ最後の行の (並べ替えキー, 施設ID) を
+# カーソル (after) として渡すと、その次の行から返します (OFFSET と違い、後ろのページでも読み飛ばしが発生しない)。
+# 並べ替えキーは search_cache と SQL で同じ値になるため、どちらの経路で作ったカーソルも使えます。
+# メモリ常駐検索エンジン (venue_search) は並べ替えキーが異なるため、カーソルには発行した検索方式 (CURSOR_ENGINES) を含め、
+# 別の方式で作られたカーソルは受け付けません。
+SUMMARY_COLUMNS = ("id", "施設名", "郵便番号", "都道府県名", "住所", "屋内外", "適用エリア")
+SEARCH_VIEWS = ("summary", "full")
+CURSOR_ENGINES = ("sqlite", "memory")
+
+def select_columns(view, alias="v"):
+    if view == "full": return f"{alias}.*"
+    return ", ".join(f'{alias}."{c}"' for c in SUMMARY_COLUMNS)
+
+def encode_cursor(key, engine):
+    return base64.urlsafe_b64encode(json.dumps([engine] + list(key), separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor, engine):
+    """encode_cursor の逆。不正な値・engine 以外の検索方式で作られたカーソルは ValueError"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+    if not (isinstance(key, list) and len(key) == 3 and key[0] in CURSOR_ENGINES
+            and all(isinstance(k, (int, float)) for k in key[1:])):
+        raise ValueError(f"invalid cursor: {cursor}")
+    if key[0] != engine: raise ValueError(f"cursor was issued by the {key[0]} search engine (current: {engine})")
+    return tuple(key[1:])
+
+def keyset_sql(key_expr, id_expr, after, key_params=()):
+    """(並べ替えキー, 施設ID) が after より後ろの行に絞る条件 (key_params は key_expr 内のパラメータ)"""
+    if after is None: return "", ()
+    return f" AND ({key_expr} > ? OR ({key_expr} = ? AND {id_expr} > ?))", key_params + (after[0],) + key_params + (after[0], after[1])
+
+def page_rows(rows, limit):
+    """limit + 1 件取り出した行から (行dictのリスト, 次ページのカーソル用キー) を作る"""
+    more = len(rows) > limit; rows = rows[:limit]
+    items = [{k: r[k] for k in r.keys() if k != "_sort_key"} for r in rows]
+    return items, ((rows[-1]["_sort_key"], rows[-1]["id"]) if more else None)
+
+def venues_by_ids(conn, ids, view="full"):
+    """施設IDの順に venues の行を dict で返す"""
+    if not ids: return []
+    sql = f"SELECT {select_columns(view)} FROM venues v WHERE v.rowid IN ({','.join('?' * len(ids))})"
+    rows = {r["id"]: dict(r) for r in conn.execute(sql, ids)}
+    return [rows[i] for i in ids if i in rows]
+
+def search_venues(conn, query, offset=0, limit=SEARCH_LIMIT, ch_filter=None, cache_generation=None, after=None, view="full", area=None):
+    """正規化済みの検索語で施設を部分一致検索し、(行dictのリスト, 次ページのカーソル用キー or None) を返す。
+    venues_fts (init_db.py / update_db.py で構築) があればそれを使い、無い旧DBでは従来の NORM() LIKE で検索する。
+    ch_filter (parse_channel_filter の戻り値) を指定すると ch_mask のビット演算で絞り込む。
+    cache_generation (接続を借りる前の data_signature) を渡すと search_cache の結果を使う (並び順は SQL と同じ)。
+    after (前ページの最後の行の並べ替えキー) を渡すとその次の行から返す。
+    area (parse_area_filter の戻り値) を指定すると都道府県・市区町村で絞り込む。"""
+    q = normalize_text(query)
+    if area and not has_area_table(conn): raise ValueError("市区町村での検索にはデータベースの再構築 (update_db.py) が必要です")
+    if not has_search_index(conn):
+        if ch_filter: raise ValueError("チャンネル条件での検索にはデータベースの再構築 (update_db.py) が必要です")
+        cols = "*" if view == "full" else ", ".join(f'"{c}"' for c in SUMMARY_COLUMNS if c != "id")
+        keyset, keyset_params = keyset_sql("0", "rowid", after)
+        sql = (f"SELECT rowid AS id, {cols}, 0 AS _sort_key FROM venues "
+               f"WHERE (NORM(施設名) LIKE ? OR NORM(住所) LIKE ? OR NORM(都道府県名) LIKE ?){keyset} ORDER BY rowid LIMIT ? OFFSET ?")
+        return page_rows(conn.execute(sql, (f"%{q}%",)*3 + keyset_params + (limit + 1, offset)).fetchall(), limit)
+    filter_sql, filter_params = "", ()
+    if ch_filter:
+        required, bmask, min_free = ch_filter
+        filter_sql = f" AND (v.ch_mask & ?) = ? AND ({free_count_sql(bmask)}) >= ?"
+        filter_params = (required, required, min_free)
+    if area:
+        pref, city = area
+        filter_sql += " AND v.id IN (SELECT id FROM venue_area WHERE pref = ?" + (" AND city = ?)" if city is not None else ")")
+        filter_params += (pref,) if city is None else (pref, city)
+    cols = select_columns(view)
+    if not q:
+        # キーワード無しは、チャンネル条件があれば帯域内の空きCHが多い順、所在地の条件のみなら施設ID順
+        key = f"-({free_count_sql(ch_filter[1])})" if ch_filter else "0"
+        keyset, keyset_params = keyset_sql(key, "v.id", after)
+        sql = f"SELECT {cols}, {key} AS _sort_key FROM venues v WHERE 1{filter_sql}{keyset} ORDER BY _sort_key, v.id LIMIT ? OFFSET ?"
+        return page_rows(conn.execute(sql, filter_params + keyset_params + (limit + 1, offset)).fetchall(), limit)
+    if cache_generation is not None and not area:
+        entry = search_cache.lookup(conn, cache_generation, q)
+        if entry is not None:
+            keys, ranked = entry
+            picked, skip, more = [], offset, False
+            for i in range(bisect.bisect_right(keys, after) if after else 0, len(ranked)):
+                if ch_filter and not channel_filter_match(ranked[i][1], ch_filter): continue
+                if skip: skip -= 1; continue
+                if len(picked) == limit: more = True; break
+                picked.append(i)
+            return venues_by_ids(conn, [ranked[i][0] for i in picked], view), (keys[picked[-1]] if more else None)
+    if len(q) >= 3:
+        # trigram トークナイザでは 3 文字以上のフレーズ検索がそのまま部分一致になる
+        key = f"bm25(venues_fts, {', '.join(map(repr, FTS_WEIGHTS))})"
+        keyset, keyset_params = keyset_sql(key, "venues_fts.rowid", after)
+        sql = (f"SELECT {cols}, {key} AS _sort_key FROM venues_fts JOIN venues v ON v.rowid = venues_fts.rowid "
+               f"WHERE venues_fts MATCH ?{filter_sql}{keyset} ORDER BY _sort_key, venues_fts.rowid LIMIT ? OFFSET ?")
+        params = ('"' + q.replace('"', '""') + '"',) + filter_params + keyset_params + (limit + 1, offset)
+        return page_rows(conn.execute(sql, params).fetchall(), limit)
+    # 2 文字以下は trigram が使えないため、正規化済みの列に対して LIKE で照合 (UDF 呼び出し無し)
+    like = f"%{q}%"
+    key = "CASE WHEN venues_fts.name LIKE ? THEN 0 WHEN venues_fts.address LIKE ? THEN 1 ELSE 2 END"
+    keyset, keyset_params = keyset_sql(key, "venues_fts.rowid", after, (like, like))
+    sql = (f"SELECT {cols}, {key} AS _sort_key FROM venues_fts JOIN venues v ON v.rowid = venues_fts.rowid "
+           f"WHERE (venues_fts.name LIKE ? OR venues_fts.address LIKE ? OR venues_fts.pref LIKE ?){filter_sql}{keyset} "
+           "ORDER BY _sort_key, venues_fts.rowid LIMIT ? OFFSET ?")
+    params = (like,)*2 + (like,)*3 + filter_params + keyset_params + (limit + 1, offset)
+    return page_rows(conn.execute(sql, params).fetchall(), limit)
+
+# メモリ常駐検索エンジン (環境変数 RF_UNYO_SEARCH_BACKEND=memory で有効化)
+SEARCH_BACKEND = os.environ.get("RF_UNYO_SEARCH_BACKEND", "sqlite")
+search_engine = None
+if SEARCH_BACKEND == "memory":
+    from venue_search import VenueSearchEngine
+    search_engine = VenueSearchEngine(DB_PATH, normalize_text)
+    Thread(target=search_engine.ensure_fresh, daemon=True).start()
+
+# --- キープリスト ---
+keep_store = KeepStore(KEEP_DB_PATH, DB_PATH)
+
+def current_keep_id():
+    """セッションに紐づくキープリストID (無ければ発行)"""
+    if "keep_id" not in session: session["keep_id"] = uuid.uuid4().hex
+    return session["keep_id"]
+
+def get_venue(venue_id):
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT * FROM venues WHERE rowid = ?", (venue_id,)).fetchone()
+    return dict(row) if row else None
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "(not found)"
+        metrics.record_request(route, request.method, response.status_code,
+                               (time.perf_counter() - started) * 1000, response.content_length or 0)
+    return response
+
+# --- 条件付きGET と圧縮 ---
+# 施設データから作るレスポンス (/search・/venue・/facets) には、施設データの版 (data_signature) と URL から作った
+# ETag を付け、If-None-Match が一致すれば検索せずに 304 を返します (DBが差し替えられると ETag も変わる)。
+# JSON レスポンスは Accept-Encoding に応じて gzip / deflate で圧縮します。
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+
+def data_etag(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = hashlib.sha1(f"{data_signature(DB_PATH)}|{request.full_path}".encode()).hexdigest()[:20]
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200: return response
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    return wrapper
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.mimetype != "application/json"
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    accepted = request.accept_encodings
+    encoding = "gzip" if accepted["gzip"] else "deflate" if accepted["deflate"] else None
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_BYTES: return response
+    response.set_data(gzip.compress(data, COMPRESS_LEVEL, mtime=0) if encoding == "gzip" else zlib.compress(data, COMPRESS_LEVEL))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+@app.route("/metrics")
+def get_metrics():
+    """ルート別のレイテンシ・レスポンスサイズ、SQL 文別の実行時間、スロークエリ、検索キャッシュのヒット率"""
+    return jsonify(metrics_snapshot())
 
 @app.route("/")
 def index():
-    if "keep_list" not in session: session["keep_list"] = []
-    return render_template("index.html")
+    current_keep_id()
+    snapshot = snapshot_cache.get()
+    snapshot_url = url_for("search_snapshot", digest=snapshot["digest"]) if snapshot else None
+    return render_template("index.html", snapshot_url=snapshot_url, fts_weights=FTS_WEIGHTS, search_limit=SEARCH_LIMIT)
+
+@app.route("/snapshot/venues.<digest>.json")
+def search_snapshot(digest):
+    """ブラウザ内検索用の施設データ (列ごとの配列。形式は db_builder.build_search_snapshot を参照)"""
+    try:
+        snapshot = snapshot_cache.get()
+        if snapshot is None or snapshot["digest"] != digest: return jsonify({"error": f"unknown snapshot: {digest}"}), 404
+        if request.if_none_match.contains(digest):
+            response = app.response_class(status=304)
+        elif request.accept_encodings["gzip"]:
+            response = app.response_class(snapshot["data"], mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = app.response_class(gzip.decompress(snapshot["data"]), mimetype="application/json")
+        response.vary.add("Accept-Encoding")
+        response.set_etag(digest)
+        response.headers["Cache-Control"] = f"public, max-age={SNAPSHOT_MAX_AGE}, immutable"
+        return response
+    except Exception as e:
+        logging.error(f"Error in /snapshot: {e}")
+        return jsonify({"error": str(e)}), 500
 
 @app.route("/adjustment")
 def adjustment():
     try:
         logging.info("Navigating to /adjustment")
-        keep_list = session.get("keep_list", [])
-        conn = get_db_connection()
-        devices = conn.execute("SELECT * FROM devices").fetchall()
-        tv_channels = conn.execute("SELECT * FROM tv_channels").fetchall()
-        conn.close()
-        dev_list = [dict(d) for d in devices]
-        ch_list = [dict(c) for c in tv_channels]
-        for d in ch_list:
-            if 'TVchannel' in d:
-                try: d['TVchannel'] = int(d['TVchannel'])
-                except: pass
-        return render_template("adjustment.html", venues=keep_list, devices=dev_list, tv_channels=ch_list)
+        keep_list = keep_store.venues(current_keep_id())
+        ref = reference_cache.get()
+        return render_template("adjustment.html", venues=keep_list, devices=ref["devices"], tv_channels=ref["tv_channels"], tv_ch_map=ref["tv_ch_map"])
     except Exception as e:
         logging.error(f"Error in /adjustment: {e}")
         return str(e), 500
@@ -172,10 +551,9 @@ def settings():
 @app.route("/get_settings")
 def get_settings():
     try:
-        conn = get_db_connection()
-        m = conn.execute("SELECT * FROM member_info WHERE id=1").fetchone()
-        u = conn.execute("SELECT * FROM onsite_user WHERE id=1").fetchone()
-        conn.close()
+        with get_db_connection() as conn:
+            m = conn.execute("SELECT * FROM member_info WHERE id=1").fetchone()
+            u = conn.execute("SELECT * FROM onsite_user WHERE id=1").fetchone()
         return jsonify({"member": dict(m) if m else {}, "user": dict(u) if u else {}})
     except Exception as e:
         logging.error(f"Error in /get_settings: {e}")
@@ -185,81 +563,201 @@ def get_settings():
 def save_settings():
     try:
         d = request.json; m, u = d.get("member", {}), d.get("user", {})
-        conn = get_db_connection()
-        conn.execute("UPDATE member_info SET member_num1=?, member_num2=?, member_name=?, department=?, manager=?, tel=?, email=? WHERE id=1",
-                    (m.get("member_num1"), m.get("member_num2"), m.get("member_name"), m.get("department"), m.get("manager"), m.get("tel"), m.get("email")))
-        conn.execute("UPDATE onsite_user SET name=?, furigana=?, tel=?, email=? WHERE id=1",
-                    (u.get("name"), u.get("furigana"), u.get("tel"), u.get("email")))
-        conn.commit(); conn.close()
+        with get_write_connection() as conn:
+            conn.execute("UPDATE member_info SET member_num1=?, member_num2=?, member_name=?, department=?, manager=?, tel=?, email=? WHERE id=1",
+                        (m.get("member_num1"), m.get("member_num2"), m.get("member_name"), m.get("department"), m.get("manager"), m.get("tel"), m.get("email")))
+            conn.execute("UPDATE onsite_user SET name=?, furigana=?, tel=?, email=? WHERE id=1",
+                        (u.get("name"), u.get("furigana"), u.get("tel"), u.get("email")))
         return jsonify({"status": "success"})
     except Exception as e:
         logging.error(f"Error in /save_settings: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/search")
+@data_etag
 def search():
+    """施設検索。{"items": [...], "next": 次ページのカーソル (after に渡す) or null}
+    view=summary (既定: 一覧表示用の列のみ) / full (全列)。詳細は /venue/<id> で取得する。
+    pref・city で都道府県・市区町村に絞り込む (件数は /facets と一致する)"""
     try:
         query = request.args.get("q", "")
-        if not query: return jsonify([])
-        conn = get_db_connection()
-        sql = "SELECT * FROM venues WHERE NORM(施設名) LIKE ? OR NORM(住所) LIKE ? OR NORM(都道府県名) LIKE ? LIMIT 100"
-        results = conn.execute(sql, (f"%{normalize_text(query)}%",)*3).fetchall()
-        conn.close()
-        return jsonify([dict(row) for row in results])
+        try: ch_filter, area = parse_channel_filter(request.args), parse_area_filter(request.args)
+        except ValueError as e: return jsonify({"error": str(e)}), 400
+        view = request.args.get("view", "summary")
+        if view not in SEARCH_VIEWS: return jsonify({"error": f"unknown view: {view}"}), 400
+        engine = "memory" if search_engine is not None and not ch_filter and not area else "sqlite"
+        try: after = decode_cursor(request.args["after"], engine) if request.args.get("after") else None
+        except ValueError as e: return jsonify({"error": str(e)}), 400
+        if not query and not ch_filter and not area: return jsonify({"items": [], "next": None})
+        offset = max(request.args.get("offset", 0, type=int), 0)
+        limit = min(max(request.args.get("limit", SEARCH_LIMIT, type=int), 1), SEARCH_LIMIT)
+        if engine == "memory":
+            _, items, next_key = search_engine.search(query, offset, limit, after)
+            if view == "summary": items = [{c: v.get(c) for c in SUMMARY_COLUMNS} for v in items]
+        else:
+            generation = data_signature(DB_PATH)
+            with get_db_connection() as conn:
+                items, next_key = search_venues(conn, query, offset, limit, ch_filter, cache_generation=generation, after=after, view=view, area=area)
+        return jsonify({"items": items, "next": encode_cursor(next_key, engine) if next_key else None})
     except Exception as e:
         logging.error(f"Error in /search: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/venue/<int:venue_id>")
+@data_etag
+def venue_detail(venue_id):
+    """施設1件の全列 (検索結果の一覧から選んだ施設の詳細表示用)"""
+    try:
+        venue = get_venue(venue_id)
+        if venue is None: return jsonify({"error": f"unknown venue id: {venue_id}"}), 404
+        return jsonify(venue)
+    except Exception as e:
+        logging.error(f"Error in /venue: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/facets")
+@data_etag
+def facets():
+    """都道府県 → 市区町村の件数と CH 別の運用可能件数 (pref 指定でその都道府県の内訳)"""
+    try:
+        f = facet_cache.get()
+        if f is None: return jsonify({"error": "集計テーブルがありません。update_db.py でデータベースを再構築してください。"}), 503
+        pref = request.args.get("pref")
+        if not pref:
+            return jsonify({"prefectures": f["prefectures"], "channels": f["total_channels"]})
+        summary = next((p for p in f["prefectures"] if p["pref"] == pref), None)
+        if summary is None: return jsonify({"error": f"unknown prefecture: {pref}"}), 404
+        return jsonify({**summary, "cities": f["cities"].get(pref, []), "channels": f["channels"].get(pref, {})})
+    except Exception as e:
+        logging.error(f"Error in /facets: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/keep", methods=["POST"])
 def keep():
-    data = request.json.get("data")
-    keep_list = session.get("keep_list", [])
-    if not any(v["施設名"] == data["施設名"] and v["住所"] == data["住所"] for v in keep_list):
-        keep_list.append(data); session["keep_list"] = keep_list; session.modified = True
-    return jsonify({"status": "success", "count": len(keep_list)})
+    try:
+        venue_id = int(request.json["id"])
+        count = keep_store.add(current_keep_id(), venue_id)
+        if count is None: return jsonify({"error": f"unknown venue id: {venue_id}"}), 404
+        return jsonify({"status": "success", "count": count})
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"invalid venue id: {e}"}), 400
 
 @app.route("/unkeep", methods=["POST"])
 def unkeep():
-    data = request.json.get("data")
-    keep_list = [v for v in session.get("keep_list", []) if not (v["施設名"] == data["施設名"] and v["住所"] == data["住所"])]
-    session["keep_list"] = keep_list; session.modified = True
-    return jsonify({"status": "success", "count": len(keep_list)})
+    try:
+        count = keep_store.remove(current_keep_id(), int(request.json["id"]))
+        return jsonify({"status": "success", "count": count})
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"invalid venue id: {e}"}), 400
+
+@app.route("/reorder_keep", methods=["POST"])
+def reorder_keep():
+    try:
+        keep_store.reorder(current_keep_id(), [int(i) for i in request.json["ids"]])
+        return jsonify({"status": "success"})
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"invalid venue ids: {e}"}), 400
 
 @app.route("/get_keep_list")
-def get_keep_list(): return jsonify(session.get("keep_list", []))
+def get_keep_list(): return jsonify(keep_store.venues(current_keep_id()))
+
+excel_exporter = None
+
+def get_excel_exporter():
+    global excel_exporter
+    if excel_exporter is None:
+        from excel_export import ExcelExporter
+        excel_exporter = ExcelExporter(MASTER_XLSX)
+    return excel_exporter
+
+# --- 出力処理 ---
+# 各出力は「リクエスト中に行う準備 (キープリスト・設定・施設の読み込み)」と「重い生成処理 (build)」に分け、
+# 同期版のルート (/export 等) はその場で build を、/jobs はジョブとしてバックグラウンドで build を実行します。
+# 準備関数の戻り値は (build(progress), ファイル名, MIMEタイプ, 進捗の工程数)。
+# 入力の誤りは KeyError / TypeError / ValueError (400)、施設が見つからない場合は VenueNotFound (404) を送出します。
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+class VenueNotFound(LookupError):
+    """出力対象の施設が見つからない (KeyError と区別して 404 を返す)"""
+
+def prepare_excel_export(payload):
+    data = payload.get("data", [])
+    kept = {v["id"]: v for v in keep_store.venues(current_keep_id())}
+    data = [{"venue_id": item.get("venue_id"), "venue": kept.get(item.get("venue_id")) or item.get("venue"),
+             "selected_channels": item["selected_channels"]} for item in data]
+    for item in data:
+        if not item["venue"] and item["venue_id"] is not None:
+            item["venue"] = get_venue(int(item["venue_id"]))
+            if not item["venue"]: raise VenueNotFound(f"venue not found: {item['venue_id']}")
+    data = [{"venue": item["venue"], "selected_channels": item["selected_channels"]} for item in data if item["venue"]]
+    with get_db_connection() as conn:
+        member = conn.execute("SELECT * FROM member_info WHERE id = 1").fetchone()
+        onsite = conn.execute("SELECT * FROM onsite_user WHERE id = 1").fetchone()
+    member, onsite = (dict(member) if member else None), (dict(onsite) if onsite else None)
+    date_str = datetime.now().strftime('%Y-%m%d')
+    from excel_export import VENUES_PER_BOOK, zip_books
+    n_books = max(1, -(-len(data) // VENUES_PER_BOOK))
+    def build(progress=None):
+        # 12施設を超える場合は12施設ずつのブックに分割し ZIP で返す
+        books = get_excel_exporter().render_books(data, member, onsite, progress)
+        logging.info(f"Excel export completed successfully. ({len(data)} venues, {len(books)} workbooks)")
+        return zip_books(books, date_str).getvalue() if len(books) > 1 else books[0]
+    if n_books > 1: return build, f"運用連絡票_{date_str}.zip", "application/zip", n_books
+    return build, f"運用連絡票_{date_str}.xlsx", XLSX_MIMETYPE, n_books
+
+def prepare_wsm_export(payload):
+    selected_channels = payload.get("selected_channels", [])
+    venue = get_venue(int(payload["venue_id"])) if "venue_id" in payload else payload.get("venue")
+    if not venue: raise VenueNotFound("venue not found")
+    carriers = [int(f) for f in payload.get("carriers", [])]
+    tv_ch_map = reference_cache.get()["tv_ch_map"]
+    def build(progress=None):
+        from wsm_export import build_wsm_csvs
+        text = build_wsm_csvs([venue], [selected_channels], tv_ch_map, [carriers])[0]
+        if progress: progress(1, 1)
+        logging.info(f"WSM CSV export completed for: {venue.get('施設名')}")
+        return text.encode('utf-8')
+    return build, f"wsm_{venue.get('施設名')}_{datetime.now().strftime('%Y-%m%d')}.csv", "text/csv", 1
+
+def prepare_wsm_bulk_export(payload):
+    items = payload.get("items")
+    if items is None:
+        venues = keep_store.venues(current_keep_id()); selected = [[] for _ in venues]
+    else:
+        ids = [int(item["venue_id"]) for item in items]
+        by_id = {}
+        if ids:
+            with get_db_connection() as conn:
+                rows = conn.execute(f"SELECT * FROM venues WHERE rowid IN ({','.join('?' * len(ids))})", ids).fetchall()
+            by_id = {r["id"]: dict(r) for r in rows}
+        pairs = [(by_id[int(item["venue_id"])], item.get("selected_channels", [])) for item in items if int(item["venue_id"]) in by_id]
+        venues, selected = [p[0] for p in pairs], [p[1] for p in pairs]
+    if not venues: raise ValueError("no venues")
+    tv_ch_map, date_str = reference_cache.get()["tv_ch_map"], datetime.now().strftime('%Y-%m%d')
+    def build(progress=None):
+        from wsm_export import build_wsm_zip
+        data = build_wsm_zip(venues, selected, tv_ch_map, date_str).getvalue()
+        if progress: progress(1, 1)
+        logging.info(f"WSM bulk export completed: {len(venues)} venues")
+        return data
+    return build, f"wsm_一括_{date_str}.zip", "application/zip", 1
+
+EXPORT_TASKS = {"export": prepare_excel_export, "export_wsm": prepare_wsm_export, "export_wsm_bulk": prepare_wsm_bulk_export}
+
+def send_export(prepare):
+    """同期版の出力ルート共通処理"""
+    try:
+        build, _, mimetype, _ = prepare(request.json or {})
+        return send_file(io.BytesIO(build()), mimetype=mimetype)
+    except VenueNotFound as e:
+        return str(e), 404
+    except (KeyError, TypeError, ValueError) as e:
+        return f"invalid request: {e}", 400
 
 @app.route("/export", methods=["POST"])
 def export():
     try:
-        data = request.json.get("data", [])
-        conn = get_db_connection()
-        member = conn.execute("SELECT * FROM member_info WHERE id = 1").fetchone()
-        onsite = conn.execute("SELECT * FROM onsite_user WHERE id = 1").fetchone()
-        conn.close()
-        temp_dir = tempfile.mkdtemp(); temp_path = os.path.join(temp_dir, "temp.xlsx")
-        shutil.copy2(MASTER_XLSX, temp_path)
-        wb = openpyxl.load_workbook(temp_path)
-        SHEETS = ["master_01", "master_02", "master_03"]
-        for sn in SHEETS:
-            if sn not in wb.sheetnames: continue
-            ws = wb[sn]; ws.cell(row=4, column=4, value="新規")
-            if member:
-                ws.cell(row=4, column=13, value=member["member_num1"]); ws.cell(row=4, column=16, value=member["member_num2"]); ws.cell(row=4, column=23, value=member["member_name"])
-                ws.cell(row=6, column=13, value=member["department"]); ws.cell(row=6, column=23, value=member["manager"]); ws.cell(row=8, column=13, value=member["tel"]); ws.cell(row=8, column=23, value=member["email"])
-            if onsite:
-                ws.cell(row=13, column=15, value=onsite["name"] + (f"（{onsite['furigana']}）" if onsite["furigana"] else ""))
-                ws.cell(row=15, column=12, value=onsite["tel"]); ws.cell(row=15, column=23, value=onsite["email"])
-        for i, item in enumerate(data[:12]):
-            ws = wb[SHEETS[i // 4]]; row = 36 + (i % 4 * 12); v, chs = item["venue"], item["selected_channels"]
-            ws.cell(row=row, column=10, value=v.get("郵便番号", "")); ws.cell(row=row, column=18, value=f"{v.get('都道府県名', '')}{v.get('住所', '')}")
-            ws.cell(row=row+2, column=12, value=v.get("屋内外", "")); ws.cell(row=row+2, column=18, value=v.get("施設名", ""))
-            ws.cell(row=row+4, column=15, value=v.get("適用エリア", "")); ws.cell(row=row+6, column=15, value=", ".join([str(c) for c in chs]))
-        wb.save(temp_path)
-        output = io.BytesIO()
-        with open(temp_path, "rb") as f: output.write(f.read())
-        output.seek(0); shutil.rmtree(temp_dir)
-        logging.info("Excel export completed successfully.")
-        return send_file(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        return send_export(prepare_excel_export)
     except Exception as e:
         logging.error(f"Export error: {e}")
         return str(e), 500
@@ -267,50 +765,226 @@ def export():
 @app.route("/export_wsm", methods=["POST"])
 def export_wsm():
     try:
-        data = request.json; venue = data.get("venue"); selected_channels = data.get("selected_channels", [])
-        conn = get_db_connection()
-        tv_ch_map = {r["TVchannel"]: r for r in conn.execute("SELECT * FROM tv_channels").fetchall()}
-        conn.close()
-        output = io.StringIO(); writer = csv.writer(output, lineterminator='\n', delimiter=';')
-        writer.writerow(["name", "type", "frequency", "tolerance", "minfrequency", "maxfrequency", "priority", "squelchlevel"])
-        for ch in range(13, 54):
-            is_available = venue.get(f"{ch}CH") == '○'; is_selected = ch in selected_channels; r = tv_ch_map.get(ch)
-            if not r: continue
-            min_f, max_f = r["minfrequency"], r["maxfrequency"]
-            if ch > 13 and is_available != (venue.get(f"{ch-1}CH") == '○'):
-                if is_available: min_f += 1000
-                else: min_f -= 1000
-            if ch < 53 and is_available != (venue.get(f"{ch+1}CH") == '○'):
-                if is_available: max_f -= 1000
-                else: max_f += 1000
-            writer.writerow([f"TV {ch}", 2 if is_selected else 3, 0, 0, min_f, max_f, 2 if is_selected else 4, 5])
-        writer.writerow(["Blocked", 3, 0, 0, 714000, 798000, 4, 5])
-        mem = io.BytesIO(); mem.write(output.getvalue().encode('utf-8')); mem.seek(0)
-        logging.info(f"WSM CSV export completed for: {venue.get('施設名')}")
-        return send_file(mem, mimetype="text/csv")
+        return send_export(prepare_wsm_export)
     except Exception as e:
         logging.error(f"WSM Export error: {e}")
         return str(e), 500
 
+@app.route("/plan_frequencies", methods=["POST"])
+def plan_frequencies():
+    """施設の運用可能CHと機器から、3次 (任意で5次) IMD を避けたキャリア周波数を計算"""
+    try:
+        d = request.json or {}
+        venue = get_venue(int(d["venue_id"]))
+        if not venue: return jsonify({"error": "venue not found"}), 404
+        ref = reference_cache.get()
+        device = next((x for x in ref["devices"] if x["name"] == d.get("device")), None)
+        if not device: return jsonify({"error": "device not found"}), 404
+        options = {"fifth_order": bool(d.get("fifth_order", False))}
+        for key in ("max_carriers", "spacing", "imd3_spacing", "imd5_spacing"):
+            if key in d: options[key] = int(d[key])
+        from freq_planner import plan_for_venue
+        t0 = time.perf_counter()
+        carriers = plan_for_venue(venue, device, ref["tv_ch_map"], d.get("selected_channels"), **options)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        logging.info(f"Frequency plan for {venue.get('施設名')} / {device['name']}: {len(carriers)} carriers in {elapsed_ms:.1f} ms")
+        return jsonify({"device": device["name"], "carriers": carriers, "count": len(carriers), "elapsed_ms": round(elapsed_ms, 1)})
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"invalid request: {e}"}), 400
+    except Exception as e:
+        logging.error(f"Error in /plan_frequencies: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/export_wsm_bulk", methods=["POST"])
+def export_wsm_bulk():
+    """複数施設の WSM CSV を ZIP で一括出力。
+    items=[{venue_id, selected_channels}, ...] を指定した場合はその施設を、省略時はキープリスト全体を対象とする"""
+    try:
+        return send_export(prepare_wsm_bulk_export)
+    except Exception as e:
+        logging.error(f"WSM bulk export error: {e}")
+        return str(e), 500
+
+# --- 出力ジョブ (export_jobs.py) ---
+# POST /jobs {"type": "export" | "export_wsm" | "export_wsm_bulk", "payload": 同期版ルートと同じ本文} -> 202 ジョブ情報
+# GET /jobs/<id> で進捗 (done / total)、完了後 GET /jobs/<id>/download で成果物、DELETE /jobs/<id> でキャンセル (終了済みは削除)。
+# ジョブはセッションのキープリストIDに紐づけ、他のセッションからは参照できません。
+JOB_DIR = Path(os.environ.get("RF_UNYO_JOB_DIR") or Path.home() / "Library" / "Caches" / "RF_Unyo_System" / "export_jobs")
+export_jobs = JobManager(JOB_DIR)
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    try:
+        d = request.json or {}
+        prepare = EXPORT_TASKS.get(d.get("type"))
+        if prepare is None: return jsonify({"error": f"unknown job type: {d.get('type')}"}), 400
+        build, filename, mimetype, steps = prepare(d.get("payload") or {})
+        job = export_jobs.submit(current_keep_id(), d["type"], build, filename, mimetype, steps)
+        return jsonify(job), 202, {"Location": f"/jobs/{job['id']}"}
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
+    except VenueNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"invalid request: {e}"}), 400
+    except Exception as e:
+        logging.error(f"Error in /jobs: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = export_jobs.get(job_id, current_keep_id())
+    if job is None: return jsonify({"error": f"unknown job: {job_id}"}), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def cancel_job(job_id):
+    job = export_jobs.cancel(job_id, current_keep_id())
+    if job is None: return jsonify({"error": f"unknown job: {job_id}"}), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/download")
+def download_job(job_id):
+    artifact = export_jobs.artifact(job_id, current_keep_id())
+    if artifact is None: return jsonify({"error": f"artifact not available: {job_id}"}), 404
+    path, filename, mimetype = artifact
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=filename)
+
 @app.route("/shutdown", methods=["POST"])
 def shutdown():
-    def kill_server(): os.kill(os.getpid(), signal.SIGTERM)
+    if app.config.get("HEADLESS"): return jsonify({"error": "ヘッドレスモードではブラウザから終了できません"}), 403
+    def kill_server(): stop_logging(); os.kill(os.getpid(), signal.SIGTERM)
     Timer(1.0, kill_server).start(); return jsonify({"status": "success"})
 
-def run_flask():
-    app.run(host="127.0.0.1", port=5001, debug=False, use_reloader=False)
+HOST, PORT = "127.0.0.1", 5001
 
-def wait_for_server():
-    for _ in range(50):
-        try:
-            with socket.create_connection(("127.0.0.1", 5001), timeout=1): return True
-        except: time.sleep(0.1)
-    return False
+def run_flask(ready, state):
+    """ソケットを bind してから ready をセットし、リクエスト処理を開始する (bind 失敗時は state["error"])"""
+    try:
+        server = make_server(HOST, PORT, app, threaded=True)
+    except OSError as e:
+        state["error"] = e; ready.set()
+        return
+    ready.set()
+    server.serve_forever()
+
+def warm_up():
+    """後回しにしたモジュールとテンプレート等を裏で読み込んでおく (初回の出力操作を待たせないため)"""
+    for name in HEAVY_MODULES: __import__(name)
+    try:
+        get_excel_exporter().load()
+        reference_cache.get()
+    except Exception as e:
+        logging.error(f"Warm-up error: {e}")
+
+def print_startup_profile():
+    print("--- 起動時間の内訳 ---")
+    prev = STARTUP_T0
+    for phase, t in startup_marks:
+        print(f"  {phase:<28} {(t - prev) * 1000:8.1f} ms  (累計 {(t - STARTUP_T0) * 1000:8.1f} ms)")
+        prev = t
+    deferred = [m for m in HEAVY_MODULES + ("openpyxl", "numpy", "pandas") if m not in sys.modules]
+    print(f"  未読み込み (遅延): {', '.join(deferred) or 'なし'}")
+
+# --- ヘッドレスモード (ウィンドウ無しで複数ユーザーに配信) ---
+# python app.py --headless [--host 0.0.0.0] [--port 5001] [--workers 4] [--threads 8]
+# webview は読み込まず、waitress (マルチスレッドの WSGI サーバー) で配信します。
+# --workers が 2 以上の場合、親プロセスが待ち受けソケットを bind し、そのソケットを引き継いだ
+# ワーカープロセスを起動します (GIL の影響を受けずにコア数に応じて処理を分散)。
+# 親プロセスはワーカーを監視し、異常終了したワーカーは起動し直します。SIGTERM / Ctrl+C で全体を停止します。
+# 読み取りは各プロセスの接続プール (読み取り専用接続) で並行に処理し、設定の更新は db.py の
+# 書き込み接続 (BEGIN IMMEDIATE) でプロセスをまたいで直列化します。/metrics はプロセスごとの集計です。
+HEADLESS_THREADS = 8
+WORKER_RESTART_DELAY_SEC = 1.0
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="RFチャンネルリスト検索システム")
+    parser.add_argument("--headless", action="store_true", help="ウィンドウを開かずにサーバーとして起動する")
+    parser.add_argument("--host", default=HOST, help=f"待ち受けアドレス (既定: {HOST}。LAN に公開する場合は 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=1, help="ワーカープロセス数 (--headless 時)")
+    parser.add_argument("--threads", type=int, default=HEADLESS_THREADS, help="ワーカーごとのスレッド数 (--headless 時)")
+    parser.add_argument("--profile-startup", action="store_true", help="起動時間の内訳を表示する")
+    parser.add_argument("--listen-fd", type=int, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def serve_socket(sock, threads):
+    """待ち受け済みのソケットで waitress を起動する (このプロセスでの配信)"""
+    from waitress import serve
+    app.config["HEADLESS"] = True
+    serve(app, sockets=[sock], threads=threads, ident="RF_Unyo_System")
+
+def worker_command(fd, threads):
+    # PyInstaller でビルドした実行ファイルは自身を、開発時は python で app.py を起動する
+    script = [] if getattr(sys, "frozen", False) else [str(Path(__file__).resolve())]
+    return [sys.executable, *script, "--headless", "--listen-fd", str(fd), "--threads", str(threads)]
+
+def rollover_logs():
+    """ワーカーはログを切り替えないため、親プロセスが日付の変わり目で切り替える"""
+    log_file_handler.acquire()
+    try:
+        if log_file_handler.shouldRollover(None): log_file_handler.doRollover()
+    finally:
+        log_file_handler.release()
+
+def serve_headless(args):
+    import socket
+    import subprocess
+    if args.listen_fd is not None:
+        serve_socket(socket.socket(fileno=args.listen_fd), args.threads)
+        return
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    logging.info(f"Headless server on {args.host}:{args.port} (workers={args.workers}, threads={args.threads})")
+    print(f"http://{args.host}:{args.port} で待ち受けています (workers={args.workers}, threads={args.threads})", flush=True)
+    if args.workers <= 1:
+        serve_socket(sock, args.threads)
+        return
+
+    stopping = Event()
+    def stop(signum, frame): stopping.set()
+    signal.signal(signal.SIGTERM, stop); signal.signal(signal.SIGINT, stop)
+    cmd = worker_command(sock.fileno(), args.threads)
+    def spawn(): return subprocess.Popen(cmd, pass_fds=(sock.fileno(),))
+    workers = [spawn() for _ in range(args.workers)]
+    try:
+        while not stopping.wait(WORKER_RESTART_DELAY_SEC):
+            rollover_logs()
+            for i, w in enumerate(workers):
+                if w.poll() is not None:
+                    logging.error(f"Worker {w.pid} exited with {w.returncode}; restarting")
+                    workers[i] = spawn()
+    finally:
+        for w in workers: w.terminate()
+        for w in workers:
+            try: w.wait(timeout=10)
+            except subprocess.TimeoutExpired: w.kill()
+        sock.close()
+        logging.info("Headless server stopped")
+
+mark_startup("アプリ初期化")
 
 if __name__ == "__main__":
-    t = Thread(target=run_flask); t.daemon = True; t.start()
-    if wait_for_server():
-        window = webview.create_window("RFチャンネルリスト検索システム", "http://127.0.0.1:5001", js_api=api, width=1200, height=800)
+    args = parse_args()
+    if args.headless:
+        serve_headless(args)
+        sys.exit(0)
+    ready, state = Event(), {}
+    t = Thread(target=run_flask, args=(ready, state)); t.daemon = True; t.start()
+    if ready.wait(timeout=10) and "error" not in state:
+        mark_startup("サーバー起動 (bind 完了)")
+        import webview
+        mark_startup("import: webview")
+        window = webview.create_window("RFチャンネルリスト検索システム", f"http://{HOST}:{PORT}", js_api=api, width=1200, height=800)
         api.window = window
+        def on_loaded():
+            window.events.loaded -= on_loaded  # 初回のページ読み込み時のみ
+            mark_startup("ウィンドウ表示 (初回ページ読み込み)")
+            if PROFILE_STARTUP: print_startup_profile()
+            Thread(target=warm_up, daemon=True).start()
+        window.events.loaded += on_loaded
         webview.start(debug=False)
+    else:
+        logging.error(f"Server failed to start: {state.get('error')}")
+    stop_logging()
     os.kill(os.getpid(), signal.SIGTERM)
@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+# --- 主要ルートのベンチマーク ---
+# database.db の施設を複製した合成DB (既定: 1倍・10倍・100倍) を作り、Flask のテストクライアントで
+# /search・/adjustment・/export・/export_wsm を決まった手順で呼び出して p50/p95/p99 とスループットを計測します。
+# 結果は JSON に保存し、--compare で前回の結果と比較できます。
+#
+#   python benchmark.py                                  # 13330 / 133300 / 1333000 件
+#   python benchmark.py --sizes 13330 --output before.json
+#   python benchmark.py --sizes 13330 --compare before.json
+#
+# 合成DBは --workdir に件数ごとに保存して再利用します (100倍は作成に数分かかります)。
+# 計測はDBごとに別プロセスで app.py を読み込んで行います (環境変数 RF_UNYO_DB_PATH / RF_UNYO_KEEP_DB_PATH /
+# RF_UNYO_JOB_DIR。キープリスト・出力ジョブも --workdir に置き、ユーザーのキャッシュフォルダには書き込みません)。
+# 各シナリオは同じリクエストを繰り返すため、検索結果キャッシュ (search_cache) を無効にした計測 (routes / scenarios:
+# 検索処理そのもの) と、有効にした計測 (warm: 2回目以降はキャッシュから返る) を別々に行って両方を記録します。
+
+BASE_DIR = Path(__file__).resolve().parent
+SEED_DB = BASE_DIR / "database.db"
+DEFAULT_SIZES = "13330,133300,1333000"
+DEFAULT_WORKDIR = Path(tempfile.gettempdir()) / "rf_unyo_bench"
+# 複製した施設の ID (実データの 48bit ID と重ならず、JS の Number でも扱える範囲)
+SYNTHETIC_ID_BASE = 1 << 48
+# 複製ごとに CH の空き状況を別の施設からずらして借りる (実在するパターンのまま組み合わせを変える)
+PATTERN_STRIDE = 7919
+
+# 検索語のミックス (ラベル, クエリ文字列)
+SEARCH_MIX = [
+    ("short_kanji", {"q": "東"}),
+    ("short_kana", {"q": "ホ"}),
+    ("two_chars", {"q": "札幌"}),
+    ("kana", {"q": "イオン"}),
+    ("kana_halfwidth", {"q": "ﾎｰﾙ"}),
+    ("kanji", {"q": "体育館"}),
+    ("long_address", {"q": "札幌市北区新琴似"}),
+    ("long_name", {"q": "市民文化会館"}),
+    ("pref", {"q": "大阪府"}),
+    ("no_hit_kanji", {"q": "存在しない施設名"}),
+    ("no_hit_ascii", {"q": "zzqxw"}),
+    ("paged", {"q": "ホテル", "offset": "200"}),
+    ("channels", {"q": "東京", "channels": "27,36"}),
+    ("min_free_only", {"min_free": "20", "band": "470-600"}),
+]
+EXPORT_SIZES = (4, 24)       # Excel 出力する施設数 (24 は2冊 = ZIP)
+KEEP_COUNT = 24
+
+# --- 合成データ ---
+def _columns(conn, table):
+    return [r[1] for r in conn.execute(f'PRAGMA table_info("{table}")')]
+
+def make_dataset(rows, path):
+    """database.db の施設を複製して rows 件の venues を持つDBを path に作る (既にあれば再利用)"""
+    if path.exists(): return path
+    sys.path.insert(0, str(BASE_DIR / "data_source"))
+    from db_builder import build_derived_tables
+    print(f"合成DBを作成中: {rows} 件 -> {path}")
+    t0 = time.perf_counter()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.unlink(missing_ok=True)
+    with closing(sqlite3.connect(SEED_DB)) as src, closing(sqlite3.connect(tmp_path)) as conn:
+        src.backup(conn)
+        cols = _columns(conn, "venues")
+        if "id" not in cols or "ch_mask" not in cols: raise RuntimeError("database.db を init_db.py / update_db.py で再構築してください")
+        ch_cols = [c for c in cols if re.fullmatch(r"\d+CH", c)] + ["ch_mask"]
+        base_cols = [c for c in cols if c != "id" and c not in ch_cols]
+        conn.execute("CREATE TEMP TABLE seed AS SELECT ROW_NUMBER() OVER (ORDER BY id) - 1 AS n, * FROM venues")
+        conn.execute("CREATE INDEX temp.idx_seed_n ON seed(n)")
+        n = conn.execute("SELECT COUNT(*) FROM seed").fetchone()[0]
+        if rows < n:
+            conn.execute("DELETE FROM venues WHERE id IN (SELECT id FROM seed WHERE n >= ?)", (rows,))
+        for k in range(1, -(-rows // n)):
+            take = min(n, rows - k * n)
+            select = [f'a."{c}" || \' {k}\'' if c == "施設名" else f'a."{c}" || \'-{k}\'' if c == "住所" else f'a."{c}"' for c in base_cols]
+            select += [f'b."{c}"' for c in ch_cols]
+            conn.execute(f'''INSERT INTO venues ("id", {", ".join(f'"{c}"' for c in base_cols + ch_cols)})
+                SELECT ? + a.n, {", ".join(select)} FROM seed a JOIN seed b ON b.n = (a.n + ?) % ?
+                WHERE a.n < ?''', (SYNTHETIC_ID_BASE + k * n, k * PATTERN_STRIDE, n, take))
+        build_derived_tables(conn)
+        conn.commit()
+        conn.execute("VACUUM")
+    os.replace(tmp_path, path)
+    print(f"  - 完了 ({time.perf_counter() - t0:.1f} 秒)")
+    return path
+
+# --- 計測 ---
+def summarize(samples):
+    """レイテンシ (秒) のリストから p50/p95/p99 (ms) とスループット (req/s) を求める"""
+    a = np.asarray(samples) * 1000
+    return {"count": len(a), "p50_ms": round(float(np.percentile(a, 50)), 3), "p95_ms": round(float(np.percentile(a, 95)), 3),
+            "p99_ms": round(float(np.percentile(a, 99)), 3), "max_ms": round(float(a.max()), 3),
+            "throughput_rps": round(len(a) / (a.sum() / 1000), 2) if a.sum() else None}
+
+def timed(samples, call, expect=200):
+    t0 = time.perf_counter()
+    resp = call()
+    samples.append(time.perf_counter() - t0)
+    if resp.status_code != expect: raise RuntimeError(f"HTTP {resp.status_code}: {resp.get_data(as_text=True)[:200]}")
+    return resp
+
+def run_scenarios(iterations):
+    """(別プロセスで) app.py を読み込み、各シナリオを iterations 回ずつ実行してルート・シナリオ別の統計を返す"""
+    sys.path.insert(0, str(BASE_DIR))
+    import app as rf_app
+    client = rf_app.app.test_client()
+    client.get("/")  # セッション (キープリストID) の発行
+    with rf_app.get_db_connection() as conn:
+        ids = [r[0] for r in conn.execute("SELECT id FROM venues ORDER BY ch_mask DESC, id LIMIT ?", (KEEP_COUNT,))]
+    for vid in ids: client.post("/keep", json={"id": vid})
+    selected = [27, 36, 44]
+
+    routes, scenarios = {}, {}
+    def record(route, label, fn):
+        samples = scenarios.setdefault(f"{route} {label}", [])
+        for _ in range(iterations): timed(samples, fn)
+        routes.setdefault(route, []).extend(samples)
+
+    for label, params in SEARCH_MIX:
+        record("/search", label, lambda p=params: client.get("/search", query_string=p))
+    record("/adjustment", f"keep{len(ids)}", lambda: client.get("/adjustment"))
+    for size in EXPORT_SIZES:
+        items = [{"venue_id": vid, "selected_channels": selected} for vid in ids[:size]]
+        record("/export", f"venues{size}", lambda items=items: client.post("/export", json={"data": items}))
+    record("/export_wsm", "single", lambda: client.post("/export_wsm", json={"venue_id": ids[0], "selected_channels": selected}))
+    with rf_app.get_db_connection() as conn:
+        total = conn.execute("SELECT COUNT(*) FROM venues").fetchone()[0]
+    return {"venues": total, "routes": {k: summarize(v) for k, v in routes.items()},
+            "scenarios": {k: summarize(v) for k, v in scenarios.items()}}
+
+def run_dataset(db_path, work_dir, iterations, search_cache):
+    """DBごとに別プロセスで計測する (app.py はモジュール読み込み時にDBパスを決めるため)。
+    search_cache=False では検索結果キャッシュを無効にする"""
+    keep_path = work_dir / "keep_list.db"
+    keep_path.unlink(missing_ok=True)
+    env = dict(os.environ, RF_UNYO_DB_PATH=str(db_path), RF_UNYO_KEEP_DB_PATH=str(keep_path),
+               RF_UNYO_JOB_DIR=str(work_dir / "export_jobs"))
+    if not search_cache: env["RF_UNYO_SEARCH_CACHE_ENTRIES"] = "0"
+    out = subprocess.run([sys.executable, __file__, "--worker", "--iterations", str(iterations)],
+                         env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def compare(current, previous):
+    """前回の結果とのルート別 p50/p95 の比 (1.0 より大きいほど遅くなった。warm はキャッシュ有効時)"""
+    print(f"\n比較: {previous.get('label')} -> {current.get('label')}")
+    for size, res in current["datasets"].items():
+        prev = previous.get("datasets", {}).get(size)
+        if not prev: continue
+        pairs = [(route, stat, prev["routes"].get(route)) for route, stat in res["routes"].items()]
+        pairs += [(f"{route} warm", stat, prev.get("warm", {}).get("routes", {}).get(route)) for route, stat in res.get("warm", {}).get("routes", {}).items()]
+        for route, stat, before in pairs:
+            if not before: continue
+            print(f"  {size:>8} {route:<17} p50 {before['p50_ms']:>9.2f} -> {stat['p50_ms']:>9.2f} ms (x{stat['p50_ms'] / before['p50_ms']:.2f})"
+                  f"   p95 {before['p95_ms']:>9.2f} -> {stat['p95_ms']:>9.2f} ms (x{stat['p95_ms'] / before['p95_ms']:.2f})")
+
+def main():
+    parser = argparse.ArgumentParser(description="RFチャンネルリスト検索システムのベンチマーク")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="合成DBの施設数 (カンマ区切り)")
+    parser.add_argument("--iterations", type=int, default=20, help="シナリオごとの実行回数")
+    parser.add_argument("--workdir", type=Path, default=DEFAULT_WORKDIR, help="合成DBの保存先")
+    parser.add_argument("--output", type=Path, default=Path("bench_results.json"))
+    parser.add_argument("--label", default=None, help="結果に付けるラベル (既定: git のコミット)")
+    parser.add_argument("--compare", type=Path, default=None, help="比較対象の結果JSON")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_scenarios(args.iterations), ensure_ascii=False))
+        return
+
+    label = args.label
+    if label is None:
+        try: label = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True).stdout.strip()
+        except OSError: label = ""
+    result = {"label": label or "unknown", "created_at": datetime.now().isoformat(timespec="seconds"),
+              "iterations": args.iterations, "datasets": {}}
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        db_path = make_dataset(size, args.workdir / f"venues_{size}.db")
+        print(f"計測中: {size} 件...")
+        work_dir = args.workdir / f"run_{size}"
+        work_dir.mkdir(parents=True, exist_ok=True)
+        res = result["datasets"][str(size)] = run_dataset(db_path, work_dir, args.iterations, search_cache=False)
+        warm = run_dataset(db_path, work_dir, args.iterations, search_cache=True)
+        res["warm"] = {"routes": warm["routes"], "scenarios": warm["scenarios"]}
+        lines = [(route, stat) for route, stat in res["routes"].items()] + [("/search warm", warm["routes"]["/search"])]
+        for route, stat in lines:
+            print(f"  {route:<17} p50 {stat['p50_ms']:>9.2f} ms  p95 {stat['p95_ms']:>9.2f} ms  p99 {stat['p99_ms']:>9.2f} ms  {stat['throughput_rps']:>8.1f} req/s")
+    args.output.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"結果を保存しました: {args.output}")
+    if args.compare: compare(result, json.loads(args.compare.read_text(encoding="utf-8")))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import unicodedata
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+# --- venues テーブル書き込み・派生テーブル構築用の共通処理 ---
+# init_db.py / update_db.py の両方から呼び出されます。
+# 検索用の正規化は app.py の normalize_text と同じ (NFKC + 小文字化) にしてください。
+
+def normalize_text(text):
+    if text is None: return ""
+    return unicodedata.normalize('NFKC', str(text)).lower()
+
+# --- 施設ID ---
+# キープリスト等から参照される安定ID。下記の列の組み合わせから決定的に算出するため、
+# データを再構築しても同じ施設には同じIDが付きます (JSの Number で扱えるよう 48bit に収める)。
+VENUE_KEY_COLUMNS = ["都道府県名", "住所", "施設名", "屋内外", "適用エリア"]
+
+def _key_part(value):
+    if value is None or value != value: return ""  # None / NaN
+    return str(value)
+
+def _venue_id(key, occurrence):
+    digest = hashlib.sha1("\x1f".join(key + (str(occurrence),)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:6], 'big')
+
+def assign_venue_ids(df):
+    """各行の施設IDを返す (キーが完全に重複する行・ハッシュ衝突は出現順の連番で区別)"""
+    seen, ids = set(), []
+    for raw in df[VENUE_KEY_COLUMNS].itertuples(index=False, name=None):
+        key, n = tuple(_key_part(v) for v in raw), 0
+        vid = _venue_id(key, n)
+        while vid in seen:
+            n += 1; vid = _venue_id(key, n)
+        seen.add(vid); ids.append(vid)
+    return ids
+
+# --- チャンネル空き状況ビットマスク ---
+# ch_mask の bit (ch - 13) が 1 = そのCHが運用可能 (○)。13CH〜53CH の 41bit を使用します。
+CH_MIN, CH_MAX = 13, 53
+
+def channel_masks(df):
+    """13CH〜53CH の ○ 列から各行の ch_mask を計算"""
+    mask = 0
+    for ch in range(CH_MIN, CH_MAX + 1):
+        col = f"{ch}CH"
+        if col in df.columns: mask = mask + (df[col] == '○').astype('int64') * (1 << (ch - CH_MIN))
+    return mask
+
+def prepare_venues(df):
+    """施設ID (先頭列) と ch_mask (末尾列) を付けた DataFrame を返す"""
+    df = df.copy()
+    df.insert(0, "id", assign_venue_ids(df))
+    df["ch_mask"] = channel_masks(df)
+    return df
+
+def _create_venues_table(conn, name, columns):
+    cols = ", ".join(f'"{c}" TEXT' for c in columns[1:-1])
+    conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+    conn.execute(f'CREATE TABLE "{name}" ("id" INTEGER PRIMARY KEY, {cols}, "ch_mask" INTEGER NOT NULL DEFAULT 0)')
+
+def write_venues(conn, df):
+    """venues テーブルを施設ID (id INTEGER PRIMARY KEY) と ch_mask 付きで作り直す"""
+    df = prepare_venues(df)
+    _create_venues_table(conn, "venues", list(df.columns))
+    df.to_sql("venues", conn, if_exists="append", index=False)
+    conn.execute("CREATE INDEX idx_venues_ch_mask ON venues(ch_mask)")
+
+def _fts_rows(conn, ids=None):
+    """venues_fts に入れる (rowid, name, address, pref)。ids 指定時はその施設だけ"""
+    sql = "SELECT rowid, 施設名, 住所, 都道府県名 FROM venues"
+    if ids is None: rows = conn.execute(sql).fetchall()
+    else: rows = [r for chunk in _chunks(ids) for r in conn.execute(f"{sql} WHERE rowid IN ({_marks(chunk)})", chunk)]
+    return [(r[0], normalize_text(r[1]), normalize_text(r[2]), normalize_text(r[3])) for r in rows]
+
+def build_search_index(conn):
+    """施設名・住所・都道府県名を正規化済みで格納した FTS5 (trigram) インデックスを再構築"""
+    print("  - 検索インデックス(venues_fts)を構築中...")
+    conn.execute("DROP TABLE IF EXISTS venues_fts")
+    conn.execute("CREATE VIRTUAL TABLE venues_fts USING fts5(name, address, pref, tokenize='trigram')")
+    conn.executemany("INSERT INTO venues_fts(rowid, name, address, pref) VALUES (?, ?, ?, ?)", _fts_rows(conn))
+    conn.execute("INSERT INTO venues_fts(venues_fts) VALUES ('optimize')")
+
+def update_search_index(conn, deleted_ids, inserted_ids):
+    """差分更新した施設の分だけ検索インデックスを入れ替える"""
+    print(f"  - 検索インデックス(venues_fts)を差分更新中 (削除 {len(deleted_ids)} 件 / 追加 {len(inserted_ids)} 件)...")
+    for chunk in _chunks(deleted_ids):
+        conn.execute(f"DELETE FROM venues_fts WHERE rowid IN ({_marks(chunk)})", chunk)
+    conn.executemany("INSERT INTO venues_fts(rowid, name, address, pref) VALUES (?, ?, ?, ?)", _fts_rows(conn, inserted_ids))
+
+# --- 集計テーブル (都道府県・市区町村・CH別の件数) ---
+PREFECTURES = ("北海道", "青森県", "岩手県", "宮城県", "秋田県", "山形県", "福島県", "茨城県", "栃木県", "群馬県",
+               "埼玉県", "千葉県", "東京都", "神奈川県", "新潟県", "富山県", "石川県", "福井県", "山梨県", "長野県",
+               "岐阜県", "静岡県", "愛知県", "三重県", "滋賀県", "京都府", "大阪府", "兵庫県", "奈良県", "和歌山県",
+               "鳥取県", "島根県", "岡山県", "広島県", "山口県", "徳島県", "香川県", "愛媛県", "高知県", "福岡県",
+               "佐賀県", "長崎県", "熊本県", "大分県", "宮崎県", "鹿児島県", "沖縄県")
+DESIGNATED_CITIES = ("札幌市", "仙台市", "さいたま市", "千葉市", "横浜市", "川崎市", "相模原市", "新潟市", "静岡市", "浜松市",
+                     "名古屋市", "京都市", "大阪市", "堺市", "神戸市", "岡山市", "広島市", "北九州市", "福岡市", "熊本市")
+# 名前の途中に「市」「郡」を含み、下のパターンでは切り出せない市
+SPECIAL_CITIES = ("四日市市", "廿日市市", "大和郡山市", "野々市市")
+# 住所 (都道府県名を除く) の先頭から市区町村を切り出すパターン (上から順に試す)
+CITY_PATTERNS = [
+    re.compile(r"^(" + "|".join(DESIGNATED_CITIES) + r")([^\d区]{1,4}区)?"),  # 政令指定都市 (+ 区)
+    re.compile(r"^(" + "|".join(SPECIAL_CITIES) + r")()"),
+    re.compile(r"^([^\d]{1,5}?郡[^\d]{1,5}?[町村])()"),                     # 郡 + 町村
+    re.compile(r"^([^\d市]{1,4}区)()"),                                       # 東京23区
+    re.compile(r"^([^\d]{1,6}?市)()"),
+    re.compile(r"^([^\d]{1,6}?[町村])()"),
+]
+
+def extract_city(address):
+    """住所から市区町村名を取り出す (判定できなければ空文字)"""
+    if not address: return ""
+    for pat in CITY_PATTERNS:
+        m = pat.match(address)
+        if m: return m.group(1) + (m.group(2) or "")
+    return ""
+
+def build_facets(conn):
+    """都道府県・市区町村別の件数、屋内/屋外の内訳、都道府県×CHの運用可能件数を集計テーブルに保存 (施設ごとの市区町村は venue_area)"""
+    print("  - 集計テーブル(facet_*)を構築中...")
+    conn.create_function("CITY", 1, extract_city, deterministic=True)
+    pref_order = {p: i for i, p in enumerate(PREFECTURES, 1)}
+    for t in ("facet_pref", "facet_city", "facet_pref_channel", "venue_area"): conn.execute(f"DROP TABLE IF EXISTS {t}")
+    # 施設ごとの市区町村 (/search の pref・city 条件で使う。facet_city の件数もこの表から数える)
+    conn.execute("CREATE TABLE venue_area (id INTEGER PRIMARY KEY, pref TEXT, city TEXT)")
+    conn.execute("INSERT INTO venue_area SELECT id, 都道府県名, CITY(住所) FROM venues")
+    conn.execute("CREATE INDEX idx_venue_area ON venue_area(pref, city)")
+    conn.execute("""CREATE TABLE facet_pref (pref TEXT PRIMARY KEY, sort_order INTEGER,
+        venue_count INTEGER, indoor_count INTEGER, outdoor_count INTEGER)""")
+    conn.execute("""CREATE TABLE facet_city (pref TEXT, city TEXT,
+        venue_count INTEGER, indoor_count INTEGER, outdoor_count INTEGER, PRIMARY KEY (pref, city))""")
+    conn.execute("CREATE TABLE facet_pref_channel (pref TEXT, ch INTEGER, free_count INTEGER, PRIMARY KEY (pref, ch))")
+    counts = "COUNT(*), SUM(屋内外 = '屋内'), SUM(屋内外 = '屋外')"
+    rows = conn.execute(f"SELECT 都道府県名, {counts} FROM venues GROUP BY 都道府県名").fetchall()
+    conn.executemany("INSERT INTO facet_pref VALUES (?, ?, ?, ?, ?)",
+                     [(r[0], pref_order.get(r[0], len(PREFECTURES) + 1)) + tuple(r[1:]) for r in rows])
+    conn.execute(f"INSERT INTO facet_city SELECT a.pref, a.city, {counts} FROM venues JOIN venue_area a ON a.id = venues.id GROUP BY 1, 2")
+    bits = ", ".join(f"SUM((ch_mask >> {ch - CH_MIN}) & 1)" for ch in range(CH_MIN, CH_MAX + 1))
+    rows = conn.execute(f"SELECT 都道府県名, {bits} FROM venues GROUP BY 都道府県名").fetchall()
+    conn.executemany("INSERT INTO facet_pref_channel VALUES (?, ?, ?)",
+                     [(r[0], ch, r[1 + ch - CH_MIN]) for r in rows for ch in range(CH_MIN, CH_MAX + 1)])
+
+# --- ブラウザ内検索用のスナップショット ---
+# 検索画面 (index.html) が施設データを一度だけ取得してブラウザ内で検索できるよう、一覧表示に使う列・
+# 正規化済みの検索キー (venues_fts と同じ値)・ch_mask を列ごとの配列にまとめた JSON を gzip 圧縮して search_snapshot に保存します。
+#   - 行は施設ID順。検索キーは表示用の値と同じ場合は null (ブラウザ側で表示用の値を使う)
+#   - 都道府県名・屋内外・適用エリアは値の一覧 (values) と各行の番号 (codes) に分けて保持
+# アプリは digest (JSON の SHA-256 の先頭16文字) を含む URL で配信し、ブラウザには長期間キャッシュさせます (データが変われば URL も変わる)。
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_COLUMNS = ("施設名", "郵便番号", "都道府県名", "住所", "屋内外", "適用エリア")
+SNAPSHOT_CODED_COLUMNS = ("都道府県名", "屋内外", "適用エリア")
+SNAPSHOT_KEY_COLUMNS = {"name": "施設名", "address": "住所", "pref": "都道府県名"}  # venues_fts の列 -> venues の列
+
+def _coded(values):
+    index = {}
+    codes = [index.setdefault(v, len(index)) for v in values]
+    return {"values": list(index), "codes": codes}
+
+def build_search_snapshot(conn, data_version=None):
+    """施設一覧のスナップショットを作り直し、その digest を返す"""
+    print("  - 検索用スナップショット(search_snapshot)を構築中...")
+    cols = ", ".join(f'"{c}"' for c in SNAPSHOT_COLUMNS)
+    rows = conn.execute(f"SELECT id, {cols}, ch_mask FROM venues ORDER BY id").fetchall()
+    columns = {c: [r[1 + i] for r in rows] for i, c in enumerate(SNAPSHOT_COLUMNS)}
+    columns.update({c: _coded(columns[c]) for c in SNAPSHOT_CODED_COLUMNS})
+    keys = {}
+    for key, col in SNAPSHOT_KEY_COLUMNS.items():
+        # 符号化した列は値の一覧 (values) に対応する検索キーを持つ
+        source = columns[col]["values"] if col in SNAPSHOT_CODED_COLUMNS else columns[col]
+        keys[key] = [None if normalize_text(v) == (v or "") else normalize_text(v) for v in source]
+    payload = {"format": SNAPSHOT_FORMAT, "data_version": data_version, "count": len(rows),
+               "id": [r[0] for r in rows], "ch_mask": [r[-1] or 0 for r in rows], "columns": columns, "keys": keys}
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    compressed = gzip.compress(data, 9, mtime=0)
+    conn.execute("DROP TABLE IF EXISTS search_snapshot")
+    conn.execute("""CREATE TABLE search_snapshot (digest TEXT PRIMARY KEY, data_version TEXT, venue_count INTEGER,
+        size INTEGER, data BLOB, created_at TEXT DEFAULT CURRENT_TIMESTAMP)""")
+    conn.execute("INSERT INTO search_snapshot(digest, data_version, venue_count, size, data) VALUES (?, ?, ?, ?, ?)",
+                 (digest, data_version, len(rows), len(data), compressed))
+    print(f"    {len(rows)} 件 / {len(data) / 1024:.0f} KB (gzip {len(compressed) / 1024:.0f} KB) / digest {digest}")
+    return digest
+
+def bump_data_version(conn):
+    """施設データの版 (data_meta.venue_data_version) を上げる。アプリは版が変わったときだけ施設データのキャッシュを捨てる (db.data_signature)"""
+    conn.execute("CREATE TABLE IF NOT EXISTS data_meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("""INSERT INTO data_meta(key, value) VALUES ('venue_data_version', '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1""")
+
+def build_derived_tables(conn, changes=None, data_version=None):
+    """venues から派生するテーブル・インデックスを再構築 (changes: sync_venues の戻り値。検索インデックスは差分だけ更新)"""
+    if changes is not None and changes["incremental"] and _table_exists(conn, "venues_fts"):
+        update_search_index(conn, changes["removed"] + changes["updated"], changes["added"] + changes["updated"])
+    else:
+        build_search_index(conn)
+    build_facets(conn)
+    build_search_snapshot(conn, data_version)
+    bump_data_version(conn)
+
+# --- 差分更新 ---
+# 新しい施設リストを一時テーブル (venues_staging) に書き込み、既存の venues と施設IDごとの内容ハッシュを比べて
+# 追加・変更・削除のあった行だけを venues に反映します。反映内容はデータ版 (data_version) ごとに venue_changes へ記録します。
+#   change = added / removed / channels (運用可能CHが変化) / updated (CH以外の列だけが変化)
+# 施設IDはキー列 (VENUE_KEY_COLUMNS) から決まるため、キー列が変わった施設は「削除 + 追加」になります。
+# venues の列構成が変わった場合 (施設IDの無い古いDBを含む) は venues を作り直します。
+
+def _chunks(ids, size=500):
+    ids = list(ids)
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+def _marks(chunk):
+    return ",".join("?" * len(chunk))
+
+def _table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def _columns(conn, table):
+    return [r[1] for r in conn.execute(f'PRAGMA table_info("{table}")')]
+
+def _content_hashes(conn, table):
+    """{施設ID: (内容ハッシュ, ch_mask)} (テーブルや id 列が無ければ空)"""
+    if not _table_exists(conn, table) or "id" not in _columns(conn, table): return {}
+    hashes = {}
+    for row in conn.execute(f'SELECT * FROM "{table}"'):
+        row = tuple(row)
+        hashes[row[0]] = (hashlib.sha1(repr(row[1:]).encode('utf-8')).digest(), row[-1] or 0)
+    return hashes
+
+def _mask_channels(mask):
+    return ",".join(str(ch) for ch in range(CH_MIN, CH_MAX + 1) if mask >> (ch - CH_MIN) & 1)
+
+def _record_changes(conn, data_version, changes, old, new, old_table):
+    conn.execute("""CREATE TABLE IF NOT EXISTS venue_changes (data_version TEXT, venue_id INTEGER, change TEXT,
+        都道府県名 TEXT, 施設名 TEXT, ch_added TEXT, ch_removed TEXT, recorded_at TEXT DEFAULT CURRENT_TIMESTAMP)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_venue_changes_version ON venue_changes(data_version)")
+    # 施設名等は、削除分は変更前のテーブル、それ以外は venues_staging から取る
+    names = {}
+    for table, ids in ((old_table, changes["removed"]), ("venues_staging", changes["added"] + changes["updated"])):
+        for chunk in _chunks(ids):
+            names.update({r[0]: (r[1], r[2]) for r in conn.execute(
+                f'SELECT id, 都道府県名, 施設名 FROM "{table}" WHERE id IN ({_marks(chunk)})', chunk)})
+    rows = []
+    for kind in ("added", "removed", "updated"):
+        for vid in changes[kind]:
+            old_mask, new_mask = old[vid][1] if vid in old else 0, new[vid][1] if vid in new else 0
+            change = "channels" if kind == "updated" and old_mask != new_mask else kind
+            rows.append((data_version, vid, change) + names.get(vid, (None, None))
+                        + (_mask_channels(new_mask & ~old_mask), _mask_channels(old_mask & ~new_mask)))
+    conn.executemany("""INSERT INTO venue_changes(data_version, venue_id, change, 都道府県名, 施設名, ch_added, ch_removed)
+        VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+
+def sync_venues(conn, df, data_version):
+    """venues を df との差分だけ更新し、変更内容を venue_changes に記録する (commit は呼び出し側で行う)
+    戻り値: {"added": [ID...], "removed": [...], "updated": [...], "incremental": 差分で反映したか}"""
+    df = prepare_venues(df)
+    columns = list(df.columns)
+    _create_venues_table(conn, "venues_staging", columns)
+    df.to_sql("venues_staging", conn, if_exists="append", index=False)
+
+    old, new = _content_hashes(conn, "venues"), _content_hashes(conn, "venues_staging")
+    changes = {"added": sorted(new.keys() - old.keys()), "removed": sorted(old.keys() - new.keys()),
+               "updated": sorted(vid for vid in new.keys() & old.keys() if new[vid][0] != old[vid][0]),
+               "incremental": _table_exists(conn, "venues") and _columns(conn, "venues") == columns}
+    print(f"  - 差分: 追加 {len(changes['added'])} 件 / 変更 {len(changes['updated'])} 件 / 削除 {len(changes['removed'])} 件")
+
+    if changes["incremental"]:
+        _record_changes(conn, data_version, changes, old, new, "venues")
+        for chunk in _chunks(changes["removed"] + changes["updated"]):
+            conn.execute(f"DELETE FROM venues WHERE id IN ({_marks(chunk)})", chunk)
+        for chunk in _chunks(changes["added"] + changes["updated"]):
+            conn.execute(f"INSERT INTO venues SELECT * FROM venues_staging WHERE id IN ({_marks(chunk)})", chunk)
+    else:
+        print("  - venuesテーブルの列構成が異なるため作り直します")
+        _record_changes(conn, data_version, changes, old, new, "venues")
+        conn.execute("DROP TABLE IF EXISTS venues")
+        _create_venues_table(conn, "venues", columns)
+        conn.execute("INSERT INTO venues SELECT * FROM venues_staging")
+        conn.execute("CREATE INDEX idx_venues_ch_mask ON venues(ch_mask)")
+    conn.execute("DROP TABLE venues_staging")
+    return changes
+
+def sync_table(conn, name, df):
+    """内容が変わっている場合だけテーブルを置き換える (tv_channels / devices 用)。戻り値は置き換えたか"""
+    if _table_exists(conn, name) and _columns(conn, name) == list(df.columns):
+        current = [tuple(r) for r in conn.execute(f'SELECT * FROM "{name}"')]
+        if current == list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)):
+            print(f"  - {name}テーブル: 変更なし")
+            return False
+    df.to_sql(name, conn, if_exists="replace", index=False)
+    return True
+
+# --- DBファイルの差し替え ---
+# 稼働中のアプリが書きかけの venues を読まないよう、現在の database.db を SQLite のバックアップ API で
+# 一時ファイルにコピーしてそこを更新し、最後に os.replace で差し替えます (同じディレクトリ内のためアトミック)。
+# アプリ側は inode の変化で新しい世代を検知して接続を開き直します (db.py)。
+# 更新中にアプリで保存された設定は、差し替え直前に一時ファイルへ取り込み直します。
+SETTINGS_TABLES = ("member_info", "onsite_user")
+
+def _copy_settings(src, dst):
+    for table in SETTINGS_TABLES:
+        if not (_table_exists(src, table) and _table_exists(dst, table)): continue
+        rows = src.execute(f'SELECT * FROM "{table}"').fetchall()
+        dst.execute(f'DELETE FROM "{table}"')
+        if rows: dst.executemany(f'INSERT INTO "{table}" VALUES ({_marks(rows[0])})', rows)
+
+@contextmanager
+def staged_database(db_path):
+    """現在のDBのコピー (一時ファイル) への接続を返し、with ブロックが正常に終われば db_path と差し替える"""
+    db_path = Path(db_path)
+    tmp_path = db_path.with_name(f".{db_path.name}.{os.getpid()}.tmp")
+    tmp_path.unlink(missing_ok=True)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        if db_path.exists():
+            with closing(sqlite3.connect(db_path)) as src: src.backup(conn)
+        yield conn
+        conn.commit()
+        conn.execute("VACUUM")  # 再構築で空いたページを詰め、差し替えるファイルを最小にする
+        if db_path.exists():
+            # 排他ロック中はアプリの設定保存を待たせ、その間に設定を取り込んで差し替える
+            with closing(sqlite3.connect(db_path, isolation_level=None, timeout=30)) as live:
+                live.execute("BEGIN EXCLUSIVE")
+                try:
+                    _copy_settings(live, conn)
+                    conn.commit(); conn.close()
+                    os.replace(tmp_path, db_path)
+                finally:
+                    live.execute("ROLLBACK")
+        else:
+            conn.close()
+            os.replace(tmp_path, db_path)
+    except BaseException:
+        conn.close()
+        tmp_path.unlink(missing_ok=True)
+        raise
@@ -1,6 +1,6 @@
 import pandas as pd
-import sqlite3
 from pathlib import Path
+from db_builder import write_venues, build_derived_tables, staged_database
 
 # --- 開発者用ツール ---
 # このスクリプトはデータベースを初期化（リセット）するためのものです。
@@ -23,29 +23,29 @@ def init_db():
 
     df = pd.read_csv(CSV_PATH)
     
-    # SQLiteに接続
-    conn = sqlite3.connect(DB_PATH)
+    # 現在のDBのコピー (一時ファイル) 上で再構築し、完了後に差し替える
+    with staged_database(DB_PATH) as conn:
+        # venuesテーブルとして保存
+        print(f"Importing data into {DB_PATH} (table: venues)...")
+        write_venues(conn, df)
     
-    # venuesテーブルとして保存
-    print(f"Importing data into {DB_PATH} (table: venues)...")
-    df.to_sql("venues", conn, if_exists="replace", index=False)
-    
-    # TVチャンネル情報のインポート (data_sourceディレクトリ内)
-    CH_CSV_PATH = BASE_DIR / "tv_channel_japan.csv"
-    if CH_CSV_PATH.exists():
-        print(f"Importing {CH_CSV_PATH} into tv_channels...")
-        df_ch = pd.read_csv(CH_CSV_PATH)
-        df_ch.to_sql("tv_channels", conn, if_exists="replace", index=False)
-
-    # デバイス情報のインポート (data_sourceディレクトリ内)
-    DEV_CSV_PATH = BASE_DIR / "Devices.csv"
-    if DEV_CSV_PATH.exists():
-        print(f"Importing {DEV_CSV_PATH} into devices...")
-        df_dev = pd.read_csv(DEV_CSV_PATH)
-        df_dev.to_sql("devices", conn, if_exists="replace", index=False)
-    
-    conn.commit()
-    conn.close()
+        # TVチャンネル情報のインポート (data_sourceディレクトリ内)
+        CH_CSV_PATH = BASE_DIR / "tv_channel_japan.csv"
+        if CH_CSV_PATH.exists():
+            print(f"Importing {CH_CSV_PATH} into tv_channels...")
+            df_ch = pd.read_csv(CH_CSV_PATH)
+            df_ch.to_sql("tv_channels", conn, if_exists="replace", index=False)
+
+        # デバイス情報のインポート (data_sourceディレクトリ内)
+        DEV_CSV_PATH = BASE_DIR / "Devices.csv"
+        if DEV_CSV_PATH.exists():
+            print(f"Importing {DEV_CSV_PATH} into devices...")
+            df_dev = pd.read_csv(DEV_CSV_PATH)
+            df_dev.to_sql("devices", conn, if_exists="replace", index=False)
+
+        # 検索インデックス等の派生テーブルを再構築
+        build_derived_tables(conn)
+
     print("Database initialization complete.")
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
 import pandas as pd
+import openpyxl
 from pathlib import Path
 import unicodedata
 import re
 import sqlite3
-import shutil
 import os
+import sys
+from contextlib import closing
+import time
+import hashlib
+from db_builder import write_venues, sync_venues, sync_table, build_derived_tables, staged_database
 
 # --- 設定 ---
 BASE_DIR = Path(__file__).resolve().parent
@@ -14,6 +19,10 @@ DB_PATH = BASE_DIR.parent / "database.db"
 ZIP_CSV = "utf_ken_all.csv"
 FACILITY_XLSX = "analoglist-20250831.xlsx"
 OUTPUT_XLSX = "analoglist_with_zip.xlsx"
+# venue_changes に記録するデータ版 (施設リストのファイル名の日付。app.py の DATA_VERSION と揃える)
+DATA_VERSION = re.search(r"\d{8}", FACILITY_XLSX).group(0)
+# 正規化済み郵便番号マスター等のキャッシュ置き場
+CACHE_DIR = BASE_DIR / ".cache"
 
 def normalize_address(text):
     if not isinstance(text, str): return ""
@@ -27,12 +36,101 @@ def normalize_address(text):
     text = re.sub(r'-+', '-', text).strip('-')
     return text
 
+KANJI_DIGITS = str.maketrans('一二三四五六七八九〇', '1234567890')
+
+def normalize_addresses(series):
+    """normalize_address の列版 (pandas の文字列メソッドで列ごと一括に処理する)"""
+    s = series.astype(str).str.normalize('NFKC').str.translate(KANJI_DIGITS)
+    s = s.str.replace(r'([0-9]+)丁目', r'\1-', regex=True)
+    s = s.str.replace(r'([0-9]+)番[地丁]?', r'\1-', regex=True)
+    s = s.str.replace(r'([0-9]+)号', r'\1', regex=True)
+    s = s.str.replace(r'[ 　]', '', regex=True)
+    return s.str.replace(r'-+', '-', regex=True).str.strip('-')
+
+# --- 中間データのキャッシュ ---
+# 元ファイルの内容ハッシュをキーに、加工済みの DataFrame を CACHE_DIR に pickle で保存します。
+# 元ファイルが変わらない限り、次回以降は読み込みだけで済みます (加工内容を変えたら CACHE_VERSION を上げる)。
+CACHE_VERSION = 1
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): h.update(block)
+    return h.hexdigest()
+
+def cached_frame(name, src_path, build):
+    """src_path から build() で作る DataFrame をキャッシュ付きで返す"""
+    cache_path = CACHE_DIR / f"{name}-v{CACHE_VERSION}-{file_hash(src_path)[:16]}.pkl"
+    if cache_path.exists():
+        print(f"  - キャッシュを使用: {cache_path.name}")
+        return pd.read_pickle(cache_path)
+    df = build()
+    CACHE_DIR.mkdir(exist_ok=True)
+    for old in CACHE_DIR.glob(f"{name}-*.pkl"): old.unlink()
+    tmp_path = cache_path.with_suffix(".tmp")
+    df.to_pickle(tmp_path); os.replace(tmp_path, cache_path)
+    return df
+
+def load_zip_master(zip_path):
+    """郵便番号CSVを読み込み、正規化済み住所キー (key) と郵便番号 (zip) の表にする (CSV順)"""
+    def build():
+        zip_df = pd.read_csv(zip_path, header=None, dtype={2: str}, encoding='utf-8')
+        zip_df = zip_df[[2, 6, 7, 8]]
+        zip_df.columns = ['zip', 'pref', 'city', 'town']
+        zip_df['town'] = zip_df['town'].replace('以下に掲載がない場合', '')
+        keys = normalize_addresses(zip_df['pref'].astype(str) + zip_df['city'].astype(str) + zip_df['town'].astype(str))
+        return pd.DataFrame({'key': keys, 'zip': zip_df['zip']}).reset_index(drop=True)
+    return cached_frame("zip_master", zip_path, build)
+
+# --- 施設リストExcelの読み書き ---
+def read_facility_xlsx(xlsx_path):
+    """施設リストExcel (先頭シート・1行目が見出し) を openpyxl の read_only モードで1行ずつ読み込む"""
+    def build():
+        wb = openpyxl.load_workbook(xlsx_path, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = next(rows)
+            data = [r for r in rows if any(v is not None for v in r)]  # 空行は読み飛ばす (read_excel と同じ)
+        finally:
+            wb.close()
+        return pd.DataFrame(data, columns=header)
+    return cached_frame("facilities", xlsx_path, build)
+
+def write_facility_xlsx(df, path):
+    """確認用Excelを openpyxl の write_only モードで書き出す"""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append(list(df.columns))
+    for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None): ws.append(row)
+    wb.save(path)
+
+# --- 郵便番号の照合 ---
+# 郵便番号マスターの「都道府県+市区町村+町域」を正規化したキー → (CSV順, 郵便番号) の辞書を作り、
+# 施設住所 (都道府県名+住所) に含まれる最長のキーを探します (キーは住所のどこに現れてもよい。先頭に建物名などが付いていても一致する)。
+# 長さ n の部分文字列を長い順に辞書で引くため、マスター全件を走査する必要はありません。
+# 同じ長さのキーが複数含まれる場合は CSV で先に出てきたものを使います (従来の「長い順に並べたマスターを先頭から走査」と同じ結果)。
+
+def build_zip_index(zip_master):
+    """正規化済み住所キー → (CSV順, 郵便番号) の辞書と、キーの最大長を返す"""
+    index = {}
+    for rank, (key, zip_code) in enumerate(zip(zip_master['key'], zip_master['zip'])):
+        if key and key not in index: index[key] = (rank, zip_code)
+    return index, max(map(len, index), default=0)
+
+def find_zip_code(index, max_len, norm_target):
+    """norm_target に含まれる最長のキーの郵便番号 (同じ長さなら CSV で先のもの。無ければ空文字)"""
+    for n in range(min(len(norm_target), max_len), 0, -1):
+        hits = [hit for i in range(len(norm_target) - n + 1) if (hit := index.get(norm_target[i:i + n])) is not None]
+        if hits: return min(hits)[1]
+    return ""
+
 def backup_database():
     """データベースのバックアップを作成"""
     if DB_PATH.exists():
         backup_path = DB_PATH.with_suffix(".db.bak")
         try:
-            shutil.copy2(DB_PATH, backup_path)
+            with closing(sqlite3.connect(DB_PATH)) as src, closing(sqlite3.connect(backup_path)) as dst:
+                src.backup(dst)
             print(f"✅ バックアップ作成完了: {backup_path.name}")
             return True
         except Exception as e:
@@ -42,30 +140,38 @@ def backup_database():
         print(f"⚠️ データベースファイルが見つかりません: {DB_PATH}")
         return False
 
-def update_database(df):
-    """DataFrameの内容でvenuesテーブルを更新。他テーブルも同期。"""
+def update_database(df, full=False):
+    """DataFrameの内容でvenuesテーブルを更新。他テーブルも同期。
+    通常は変更のあった施設だけを反映し、変更内容を venue_changes に記録する (full=True で全件作り直し)。
+    更新は現在のDBのコピー上で行い、完了後にファイルごと差し替える (稼働中のアプリは停止不要)。"""
     print(f"データベース更新中: {DB_PATH.name}...")
+    t0 = time.perf_counter()
     try:
-        conn = sqlite3.connect(DB_PATH)
-        # 1. venuesテーブルの更新
-        print("  - venuesテーブルを更新中...")
-        df.to_sql("venues", conn, if_exists="replace", index=False)
-        
-        # 2. TVチャンネル情報の同期 (data_sourceにある場合)
-        CH_CSV = BASE_DIR / "tv_channel_japan.csv"
-        if CH_CSV.exists():
-            print("  - tv_channelsテーブルを更新中...")
-            pd.read_csv(CH_CSV).to_sql("tv_channels", conn, if_exists="replace", index=False)
-
-        # 3. デバイス情報の同期 (data_sourceにある場合)
-        DEV_CSV = BASE_DIR / "Devices.csv"
-        if DEV_CSV.exists():
-            print("  - devicesテーブルを更新中...")
-            pd.read_csv(DEV_CSV).to_sql("devices", conn, if_exists="replace", index=False)
-            
-        conn.commit()
-        conn.close()
-        print("✅ データベースの更新が完了しました。")
+        with staged_database(DB_PATH) as conn:
+            # 1. TVチャンネル情報の同期 (data_sourceにある場合)
+            CH_CSV = BASE_DIR / "tv_channel_japan.csv"
+            if CH_CSV.exists():
+                print("  - tv_channelsテーブルを同期中...")
+                sync_table(conn, "tv_channels", pd.read_csv(CH_CSV))
+
+            # 2. デバイス情報の同期 (data_sourceにある場合)
+            DEV_CSV = BASE_DIR / "Devices.csv"
+            if DEV_CSV.exists():
+                print("  - devicesテーブルを同期中...")
+                sync_table(conn, "devices", pd.read_csv(DEV_CSV))
+
+            # 3. venuesテーブルの更新
+            if full:
+                print("  - venuesテーブルを作り直し中...")
+                write_venues(conn, df)
+                changes = None
+            else:
+                print(f"  - venuesテーブルを差分更新中 (データ版: {DATA_VERSION})...")
+                changes = sync_venues(conn, df, DATA_VERSION)
+
+            # 4. 検索インデックス等の派生テーブルを再構築
+            build_derived_tables(conn, changes, DATA_VERSION)
+        print(f"✅ データベースの更新が完了しました。({time.perf_counter() - t0:.2f} 秒)")
     except Exception as e:
         print(f"❌ データベース更新エラー: {e}")
         raise e
@@ -83,39 +189,33 @@ def main():
             raise FileNotFoundError(f"郵便番号CSVが見つかりません: {zip_path}")
             
         print(f"読み込み中: {ZIP_CSV}...")
-        zip_df = pd.read_csv(zip_path, header=None, dtype={2: str}, encoding='utf-8')
-        zip_df = zip_df[[2, 6, 7, 8]]
-        zip_df.columns = ['zip', 'pref', 'city', 'town']
-        zip_df['town'] = zip_df['town'].replace('以下に掲載がない場合', '')
+        t0 = time.perf_counter()
+        zip_master = load_zip_master(zip_path)
+        print(f"  - 正規化済み: {len(zip_master)} 件 ({time.perf_counter() - t0:.2f} 秒)")
         
-        print("郵便番号マスター構築中（高速マッチング用）...")
-        zip_list = []
-        for _, row in zip_df.iterrows():
-            full = normalize_address(str(row['pref']) + str(row['city']) + str(row['town']))
-            if full:
-                zip_list.append((full, row['zip']))
+        print("郵便番号マスター構築中（住所キーの部分一致インデックス）...")
+        t0 = time.perf_counter()
+        zip_index, max_len = build_zip_index(zip_master)
+        print(f"  - キー数: {len(zip_index)} 件 ({time.perf_counter() - t0:.2f} 秒)")
         
         # 2. 施設リスト(Excel)の読み込み
         xlsx_path = BASE_DIR / FACILITY_XLSX
         if not xlsx_path.exists():
             raise FileNotFoundError(f"施設リストExcelが見つかりません: {xlsx_path}")
             
-        f_df = pd.read_excel(xlsx_path)
+        print(f"読み込み中: {FACILITY_XLSX}...")
+        t0 = time.perf_counter()
+        f_df = read_facility_xlsx(xlsx_path)
+        print(f"  - {len(f_df)} 件 ({time.perf_counter() - t0:.2f} 秒)")
 
         print(f"住所を照合中（全 {len(f_df)} 件）...")
-        zip_list.sort(key=lambda x: len(x[0]), reverse=True)
-
-        def find_zip_code(row):
-            raw_addr = str(row['都道府県名']) + str(row['住所'])
-            norm_target = normalize_address(raw_addr)
-            if not norm_target: return ""
-            for addr_key, zip_code in zip_list:
-                if addr_key in norm_target:
-                    return zip_code
-            return ""
+        t0 = time.perf_counter()
+        targets = normalize_addresses(f_df['都道府県名'].astype(str) + f_df['住所'].astype(str))
         
         f_df['53CH'] = '○'
-        f_df['郵便番号'] = f_df.apply(find_zip_code, axis=1)
+        f_df['郵便番号'] = [find_zip_code(zip_index, max_len, t) if t else "" for t in targets]
+        matched = (f_df['郵便番号'] != "").sum()
+        print(f"  - 照合成功: {matched} / {len(f_df)} 件 ({matched / max(len(f_df), 1):.1%}, {time.perf_counter() - t0:.2f} 秒)")
         f_df['郵便番号'] = f_df['郵便番号'].apply(lambda x: f"{x[:3]}-{x[3:]}" if len(str(x)) == 7 else x)
 
         cols = f_df.columns.tolist()
@@ -123,12 +223,14 @@ def main():
             cols.insert(0, cols.pop(cols.index('郵便番号')))
             f_df = f_df[cols]
 
-        # 4. Excel保存 (確認用)
-        f_df.to_excel(BASE_DIR / OUTPUT_XLSX, index=False)
-        print(f"Excelファイル保存完了: {OUTPUT_XLSX}")
+        # 4. Excel保存 (確認用。--no-excel で省略)
+        if "--no-excel" not in sys.argv:
+            t0 = time.perf_counter()
+            write_facility_xlsx(f_df, BASE_DIR / OUTPUT_XLSX)
+            print(f"Excelファイル保存完了: {OUTPUT_XLSX} ({time.perf_counter() - t0:.2f} 秒)")
 
         # 5. データベース自動更新
-        update_database(f_df)
+        update_database(f_df, full="--full" in sys.argv)
         
         success_count = (f_df['郵便番号'] != "").sum()
         print(f"\nすべての処理が正常に終了しました！ 照合成功: {success_count} / {len(f_df)} 件")
@@ -0,0 +1,148 @@
+import os
+import sqlite3
+import threading
+import queue
+from contextlib import contextmanager
+
+# --- SQLite 接続管理 ---
+# リクエストごとに接続を開閉せず、読み取り専用接続をプールして使い回します。
+# 読み取り接続は URI の mode=ro + query_only で開き、mmap / ページキャッシュを有効にします。
+# 設定 (member_info / onsite_user) の更新は専用の書き込み接続をロック付きで使用します
+# (BEGIN IMMEDIATE でファイルの書き込みロックも取るため、複数プロセスからの更新も直列化されます)。
+# 更新頻度の低い参照テーブル (tv_channels / devices) は ReferenceCache でメモリ上に保持します。
+# update_db.py / init_db.py は一時ファイルで新しいDBを作ってから rename で差し替えるため、
+# ファイルの inode (世代) が変わったら古い世代の接続は捨てて開き直します (処理中の接続は古いファイルを読み続けます)。
+
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 16 * 1024
+CACHED_STATEMENTS = 256
+BUSY_TIMEOUT_SEC = 5.0
+
+def file_signature(path):
+    """DBファイルの内容変更判定用シグネチャ (inode・更新時刻・サイズ)"""
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def file_generation(path):
+    """DBファイルの世代 (差し替えで変わる inode。アプリ自身の書き込みでは変わらない)"""
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino)
+
+# --- 施設データの版 ---
+# 施設データから作るキャッシュ (参照テーブル・検索インデックス・ETag 等) のキー。
+# DBファイルの世代と、init_db.py / update_db.py が施設データを作り直したときだけ上げる data_meta.venue_data_version の組です。
+# 設定 (member_info / onsite_user) の保存は mtime を変えますが、この版は変わらないためキャッシュは捨てられません
+# (mtime が変わったときは版を読み直すだけ)。
+_data_versions = {}
+_data_versions_lock = threading.Lock()
+
+def read_data_version(conn):
+    """data_meta.venue_data_version (data_meta の無い古いDBでは None)"""
+    try: row = conn.execute("SELECT value FROM data_meta WHERE key = 'venue_data_version'").fetchone()
+    except sqlite3.OperationalError: return None
+    return row[0] if row else None
+
+def data_signature(path):
+    """施設データの版: (st_dev, st_ino, venue_data_version)"""
+    signature = file_signature(path)
+    with _data_versions_lock:
+        cached = _data_versions.get(str(path))
+    if cached is not None and cached[0] == signature: return cached[1]
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=BUSY_TIMEOUT_SEC)
+    try: version = read_data_version(conn)
+    finally: conn.close()
+    result = file_generation(path) + (version,)
+    with _data_versions_lock:
+        _data_versions[str(path)] = (signature, result)
+    return result
+
+class ConnectionPool:
+    def __init__(self, db_path, normalize, max_idle=8):
+        self.db_path = db_path
+        self.normalize = normalize
+        self.max_idle = max_idle
+        self._idle = queue.LifoQueue()
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._writer_generation = None
+
+    def _open(self, readonly):
+        if readonly:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=BUSY_TIMEOUT_SEC,
+                                   check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        else:
+            conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_SEC,
+                                   check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        conn.create_function("NORM", 1, self.normalize, deterministic=True)
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+        if readonly: conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    @contextmanager
+    def read(self):
+        """読み取り専用接続をプールから借りる。with ブロックを抜けるとプールへ返却される"""
+        generation = file_generation(self.db_path)
+        conn = None
+        while conn is None:
+            try: gen, c = self._idle.get_nowait()
+            except queue.Empty: gen, c = generation, self._open(readonly=True)
+            if gen == generation: conn = c
+            else: c.close()  # 差し替え前の世代
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction: conn.rollback()
+            if self._idle.qsize() < self.max_idle: self._idle.put((generation, conn))
+            else: conn.close()
+
+    @contextmanager
+    def write(self):
+        """書き込み用接続を排他的に借りる。正常終了で commit、例外時は rollback"""
+        with self._write_lock:
+            while True:
+                generation = file_generation(self.db_path)
+                if self._writer is not None and self._writer_generation != generation:
+                    self._writer.close(); self._writer = None
+                if self._writer is None:
+                    self._writer, self._writer_generation = self._open(readonly=False), generation
+                # 他プロセス (ヘッドレスモードのワーカー) の書き込みとも直列化するため、最初に書き込みロックを取る。
+                # DB差し替え (staged_database) の排他ロック解除を待っていた場合はファイルが入れ替わっているので、
+                # 古いファイルに書き込まないよう開き直して取り直す
+                self._writer.execute("BEGIN IMMEDIATE")
+                if file_generation(self.db_path) == generation: break
+                self._writer.rollback(); self._writer.close(); self._writer = None
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    def close_all(self):
+        while True:
+            try: self._idle.get_nowait()[1].close()
+            except queue.Empty: break
+        with self._write_lock:
+            if self._writer is not None: self._writer.close(); self._writer = None
+
+class ReferenceCache:
+    """参照テーブルを loader(conn) で加工済みの構造にしてキャッシュする。
+    施設データの版 (data_signature) が変わった (update_db.py 等で更新された) 場合のみ再読み込みする。"""
+    def __init__(self, pool, loader):
+        self.pool = pool
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._signature = None
+        self._value = None
+
+    def get(self):
+        signature = data_signature(self.pool.db_path)
+        if self._signature == signature: return self._value
+        with self._lock:
+            if self._signature != signature:
+                with self.pool.read() as conn:
+                    self._value = self.loader(conn)
+                self._signature = signature
+            return self._value
@@ -0,0 +1,280 @@
+import io
+import logging
+import os
+import re
+import struct
+import threading
+import zipfile
+import zlib
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# --- 運用連絡票 (master.xlsx) の Excel 出力 ---
+# テンプレートは1冊あたり master_01〜03 の3シート × 4施設 = 12施設分。
+# 12施設を超える場合は12施設ずつ複数のブックに分割して ZIP にまとめます。
+# 一時ディレクトリへのコピーは行わず、すべてメモリ上で生成します。
+# 生成方法は2通りあります (環境変数 RF_UNYO_EXCEL_ENGINE で切り替え):
+#   - xml (既定): テンプレートを ZIP のまま扱い、master_01〜03 の書き込み対象セルの XML だけを差し替えます。
+#     それ以外のパーツは圧縮済みのバイト列をそのままコピーし、シートの変わらない部分も読み込み時に一度だけ圧縮しておきます。
+#   - openpyxl: テンプレートをパースしてセルに書き込み、ブック全体を保存し直します。
+#     パース済みのブックは常駐ワーカースレッドごとに保持して使い回します
+#     (書き込み対象セルは毎回テンプレートの値に戻してから書き込むため、前回の内容は残りません)。
+# どちらもセルの値・型・書式は同じになります (xml 側は openpyxl と同じくインライン文字列で書き込みます)。
+# xml 側でテンプレートに書き込み対象のセルが見つからない場合は openpyxl 側に切り替えます。
+
+SHEETS = ["master_01", "master_02", "master_03"]
+SLOTS_PER_SHEET = 4
+VENUES_PER_BOOK = len(SHEETS) * SLOTS_PER_SHEET
+SLOT_FIRST_ROW, SLOT_ROW_STEP = 36, 12
+EXPORT_WORKERS = 4
+EXCEL_ENGINE = os.environ.get("RF_UNYO_EXCEL_ENGINE", "xml")
+
+def header_cells(member, onsite):
+    """各シート共通のヘッダー部 ((行, 列), 値) のリスト"""
+    cells = [((4, 4), "新規")]
+    if member:
+        cells += [((4, 13), member["member_num1"]), ((4, 16), member["member_num2"]), ((4, 23), member["member_name"]),
+                  ((6, 13), member["department"]), ((6, 23), member["manager"]), ((8, 13), member["tel"]), ((8, 23), member["email"])]
+    if onsite:
+        cells += [((13, 15), onsite["name"] + (f"（{onsite['furigana']}）" if onsite["furigana"] else "")),
+                  ((15, 12), onsite["tel"]), ((15, 23), onsite["email"])]
+    return cells
+
+def slot_cells(slot, item):
+    """ブック内 slot 番目 (0〜11) の施設欄: (シート名, [((行, 列), 値), ...])"""
+    row = SLOT_FIRST_ROW + (slot % SLOTS_PER_SHEET) * SLOT_ROW_STEP
+    v, chs = item["venue"], item["selected_channels"]
+    return SHEETS[slot // SLOTS_PER_SHEET], [
+        ((row, 10), v.get("郵便番号", "")), ((row, 18), f"{v.get('都道府県名', '')}{v.get('住所', '')}"),
+        ((row + 2, 12), v.get("屋内外", "")), ((row + 2, 18), v.get("施設名", "")),
+        ((row + 4, 15), v.get("適用エリア", "")), ((row + 6, 15), ", ".join([str(c) for c in chs]))]
+
+def target_cells():
+    """テンプレート上で書き込み対象となり得る全セル: {シート名: [(行, 列), ...]}"""
+    header = [rc for rc, _ in header_cells({k: "" for k in ("member_num1", "member_num2", "member_name", "department", "manager", "tel", "email")},
+                                           {"name": "", "furigana": "", "tel": "", "email": ""})]
+    targets = {sn: list(header) for sn in SHEETS}
+    dummy = {"venue": {}, "selected_channels": []}
+    for slot in range(VENUES_PER_BOOK):
+        sn, cells = slot_cells(slot, dummy)
+        targets[sn] += [rc for rc, _ in cells]
+    return targets
+
+class _TemplateBook:
+    """パース済みテンプレート1冊 (スレッドごとに1つ)"""
+    def __init__(self, template_bytes):
+        import openpyxl
+        self.wb = openpyxl.load_workbook(io.BytesIO(template_bytes))
+        self.original = {sn: [(rc, self.wb[sn].cell(row=rc[0], column=rc[1]).value) for rc in rcs]
+                         for sn, rcs in target_cells().items() if sn in self.wb.sheetnames}
+
+    def render(self, items, member, onsite):
+        # ws.cell(..., value=None) は値を変更しないため、空欄に戻すセルも .value へ直接代入する
+        for sn, cells in self.original.items():
+            ws = self.wb[sn]
+            for (r, c), value in cells: ws.cell(row=r, column=c).value = value
+        header = header_cells(member, onsite)
+        for sn in self.original:
+            ws = self.wb[sn]
+            for (r, c), value in header: ws.cell(row=r, column=c, value=value)
+        for slot, item in enumerate(items[:VENUES_PER_BOOK]):
+            sn, cells = slot_cells(slot, item)
+            ws = self.wb[sn]
+            for (r, c), value in cells: ws.cell(row=r, column=c, value=value)
+        output = io.BytesIO(); self.wb.save(output)
+        return output.getvalue()
+
+# --- テンプレートの XML を直接書き換える出力 ---
+NS_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+ZIP_LOCAL, ZIP_CENTRAL, ZIP_END = struct.Struct("<4s5H3L2H"), struct.Struct("<4s6H3L5H2L"), struct.Struct("<4s4H2LH")
+# openpyxl と同じく XML に書けない制御文字を含む値は拒否する
+ILLEGAL_CHARACTERS_RE = re.compile(r"[\000-\010]|[\013-\014]|[\016-\037]")
+MAX_STRING_LEN = 32767
+
+def _cell_ref(row, col):
+    letters = ""
+    while col: col, rem = divmod(col - 1, 26); letters = chr(65 + rem) + letters
+    return f"{letters}{row}"
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _cell_xml(ref, style, value):
+    """openpyxl が書き出すものと同じ <c> 要素"""
+    attrs = f'r="{ref}"' + (f' s="{style}"' if style else "")
+    if isinstance(value, bool): return f'<c {attrs} t="b"><v>{int(value)}</v></c>'.encode()
+    if isinstance(value, (int, float)): return f'<c {attrs} t="n"><v>{value!r}</v></c>'.encode()
+    value = str(value)[:MAX_STRING_LEN]
+    if ILLEGAL_CHARACTERS_RE.search(value): raise ValueError(f"Excel に書き込めない文字が含まれています ({ref})")
+    if len(value) > 1 and value.startswith("="): return f"<c {attrs}><f>{_escape(value[1:])}</f><v></v></c>".encode()
+    if value == "": return f'<c {attrs} t="inlineStr"/>'.encode()
+    space = ' xml:space="preserve"' if value.strip() != value else ""
+    return f'<c {attrs} t="inlineStr"><is><t{space}>{_escape(value)}</t></is></c>'.encode()
+
+def _deflate_segment(data):
+    """単独で圧縮した deflate ブロック (最終ブロックにせずバイト境界で終える)。並べてつなげられる"""
+    c = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+
+def _stored_blocks(data):
+    """data をそのまま格納する非圧縮の deflate ブロック (セル1つ分の短いデータ用)"""
+    out = bytearray()
+    for i in range(0, len(data), 0xFFFF):
+        chunk = data[i:i + 0xFFFF]
+        out += struct.pack("<BHH", 0, len(chunk), len(chunk) ^ 0xFFFF) + chunk
+    return bytes(out)
+
+DEFLATE_END = b"\x03\x00"  # 空の最終ブロック
+
+def _dos_time(date_time):
+    y, mo, d, h, mi, sec = date_time
+    return (h << 11) | (mi << 5) | (sec // 2), ((y - 1980) << 9) | (mo << 5) | d
+
+class _PatchedTemplate:
+    """ZIP のままのテンプレート。書き込み対象セルの位置を事前に調べておき、セルの XML だけを差し替えてブックを作る (スレッドセーフ)"""
+    def __init__(self, template_bytes):
+        zf = zipfile.ZipFile(io.BytesIO(template_bytes))
+        sheet_parts = self._sheet_parts(zf)
+        self.parts = []  # (ZipInfo, (圧縮済みバイト列, CRC, 元のサイズ) / None, (シート名, 分割情報) / None)
+        for info in zf.infolist():
+            if info.filename in sheet_parts:
+                sn = sheet_parts[info.filename]
+                self.parts.append((info, None, (sn, self._split_sheet(zf.read(info), sn))))
+            elif info.filename == "xl/workbook.xml":
+                # openpyxl の保存と同じく、開いたときに数式 (TODAY() 等) を再計算させる
+                xml = zf.read(info)
+                if b"fullCalcOnLoad" not in xml: xml = xml.replace(b"<calcPr ", b'<calcPr fullCalcOnLoad="1" ', 1)
+                self.parts.append((info, (_deflate_segment(xml) + DEFLATE_END, zlib.crc32(xml), len(xml)), None))
+            else:
+                offset = info.header_offset
+                name_len, extra_len = struct.unpack("<2H", template_bytes[offset + 26:offset + 30])
+                start = offset + 30 + name_len + extra_len
+                self.parts.append((info, (template_bytes[start:start + info.compress_size], info.CRC, info.file_size), None))
+
+    @staticmethod
+    def _sheet_parts(zf):
+        """{シートのパーツ名: シート名} (SHEETS のみ)"""
+        rels = {r.get("Id"): r.get("Target") for r in ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))}
+        parts = {}
+        for sheet in ET.fromstring(zf.read("xl/workbook.xml")).iter(f"{NS_MAIN}sheet"):
+            if sheet.get("name") in SHEETS:
+                target = rels[sheet.get(f"{NS_REL}id")]
+                parts[target.lstrip("/") if target.startswith("/") else f"xl/{target}"] = sheet.get("name")
+        if len(parts) != len(SHEETS): raise ValueError("テンプレートに必要なシートがありません")
+        return parts
+
+    @staticmethod
+    def _split_sheet(xml, sheet_name):
+        """シートの XML を書き込み対象セルの位置で分割する。
+        戻り値は (変わらない部分の圧縮済みセグメント, その CRC 計算用の生データ, [(セル位置, スタイル, 元の <c> 要素), ...])"""
+        cells = []
+        for r, c in sorted(set(target_cells()[sheet_name])):
+            ref = _cell_ref(r, c)
+            m = re.search(rb'<c r="' + ref.encode() + rb'"(?:\s[^>]*?)?(?:/>|>.*?</c>)', xml, re.S)
+            if m is None: raise ValueError(f"テンプレートの {sheet_name}!{ref} にセルがありません")
+            style = re.search(rb'\ss="(\d+)"', m.group(0)[:m.group(0).index(b">")])
+            cells.append((m.start(), m.end(), (r, c), style.group(1).decode() if style else None, m.group(0)))
+        cells.sort()
+        raw, pos = [], 0
+        for start, end, *_ in cells:
+            raw.append(xml[pos:start]); pos = end
+        raw.append(xml[pos:])
+        return [_deflate_segment(seg) for seg in raw], raw, [(rc, style, elem) for _, _, rc, style, elem in cells]
+
+    def _render_sheet(self, split, values):
+        segments, raw, cells = split
+        data, crc, size = [segments[0]], zlib.crc32(raw[0]), len(raw[0])
+        for i, ((r, c), style, elem) in enumerate(cells, 1):
+            value = values.get((r, c))
+            xml = elem if value is None else _cell_xml(_cell_ref(r, c), style, value)
+            data += [_stored_blocks(xml), segments[i]]
+            crc = zlib.crc32(raw[i], zlib.crc32(xml, crc)); size += len(xml) + len(raw[i])
+        data.append(DEFLATE_END)
+        return b"".join(data), crc, size
+
+    def render(self, items, member, onsite):
+        values = {sn: {} for sn in SHEETS}
+        header = header_cells(member, onsite)
+        for sn in SHEETS: values[sn].update(header)
+        for slot, item in enumerate(items[:VENUES_PER_BOOK]):
+            sn, cells = slot_cells(slot, item)
+            values[sn].update(cells)
+        out, central = io.BytesIO(), []
+        for info, packed, sheet in self.parts:
+            compressed, crc, size = packed if sheet is None else self._render_sheet(sheet[1], values[sheet[0]])
+            method = info.compress_type if sheet is None and info.filename != "xl/workbook.xml" else zipfile.ZIP_DEFLATED
+            name, (dtime, ddate), flags = info.filename.encode(), _dos_time(info.date_time), info.flag_bits & 0x800
+            central.append(ZIP_CENTRAL.pack(b"PK\x01\x02", 20, 20, flags, method, dtime, ddate, crc, len(compressed), size,
+                                            len(name), 0, 0, 0, 0, info.external_attr, out.tell()) + name)
+            out.write(ZIP_LOCAL.pack(b"PK\x03\x04", 20, flags, method, dtime, ddate, crc, len(compressed), size, len(name), 0))
+            out.write(name); out.write(compressed)
+        offset = out.tell()
+        for entry in central: out.write(entry)
+        out.write(ZIP_END.pack(b"PK\x05\x06", 0, 0, len(central), len(central), out.tell() - offset, offset, 0))
+        return out.getvalue()
+
+class ExcelExporter:
+    def __init__(self, template_path, workers=EXPORT_WORKERS, engine=EXCEL_ENGINE):
+        self.template_path = template_path
+        self.workers = workers
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._template_bytes = None
+        self._patched = None
+        self._local = threading.local()
+        self._executor = None
+
+    def load(self):
+        """テンプレートを読み込む (xml 方式では書き込み対象セルの位置の解析と圧縮も行う)"""
+        with self._lock:
+            if self._template_bytes is None:
+                with open(self.template_path, "rb") as f: self._template_bytes = f.read()
+            if self.engine == "xml" and self._patched is None:
+                try:
+                    self._patched = _PatchedTemplate(self._template_bytes)
+                except (ValueError, KeyError, zipfile.BadZipFile) as e:
+                    logging.warning(f"Excel template cannot be patched directly, using openpyxl: {e}")
+                    self.engine = "openpyxl"
+        return self
+
+    def _book(self):
+        book = getattr(self._local, "book", None)
+        if book is None:
+            book = self._local.book = _TemplateBook(self.load()._template_bytes)
+        return book
+
+    def _render(self, items, member, onsite):
+        return self._book().render(items, member, onsite)
+
+    def render_books(self, data, member, onsite, progress=None):
+        """data を12施設ずつに分割し、各ブックの xlsx バイト列を並び順どおりに返す。
+        progress(完成した冊数, 全冊数) を渡すと1冊できるたびに呼ぶ (例外を送出した場合は残りのブックを取り消して中断)"""
+        batches = [data[i:i + VENUES_PER_BOOK] for i in range(0, len(data), VENUES_PER_BOOK)] or [[]]
+        if self.load().engine == "xml":
+            # 1冊数ミリ秒のため、呼び出し元のスレッドで順に作る
+            books = []
+            for batch in batches:
+                books.append(self._patched.render(batch, member, onsite))
+                if progress: progress(len(books), len(batches))
+            return books
+        # 1冊だけの場合も常駐スレッドで処理する (リクエストスレッドは毎回変わるためパース済みブックを再利用できない)
+        with self._lock:
+            if self._executor is None: self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="excel-export")
+        futures = [self._executor.submit(self._render, b, member, onsite) for b in batches]
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if progress: progress(done, len(futures))
+        except BaseException:
+            for future in futures: future.cancel()
+            raise
+        return [future.result() for future in futures]
+
+def zip_books(books, date_str):
+    mem = io.BytesIO()
+    with zipfile.ZipFile(mem, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i, data in enumerate(books, 1):
+            zf.writestr(f"運用連絡票_{date_str}_{i:02d}.xlsx", data)
+    mem.seek(0)
+    return mem
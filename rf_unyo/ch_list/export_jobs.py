@@ -0,0 +1,175 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# --- 出力ジョブ (Excel / WSM CSV のバックグラウンド生成) ---
+# 出力処理をリクエスト内で実行せず、ジョブとして登録してスレッドプール (JOB_WORKERS 本) で生成します。
+# 画面は /jobs/<id> で進捗を確認し、完了後に /jobs/<id>/download で成果物を受け取ります。
+# ジョブの状態は job_dir の SQLite (jobs.db)、成果物は同じディレクトリのファイルに保存するため、
+# ヘッドレスモードで別のワーカープロセスが進捗確認・ダウンロード・キャンセルを受けても同じジョブを参照できます。
+# キャンセルは cancel_requested を立て、実行中のジョブは進捗報告のたびに確認して中断します。
+# 完了から ARTIFACT_TTL_SEC 経過したジョブと成果物、実行していたプロセスが終了したジョブは cleanup() で片付けます。
+
+JOB_WORKERS = 2
+MAX_PENDING_JOBS = 16          # プロセスごとの実行中 + 待機中ジョブの上限
+ARTIFACT_TTL_SEC = 3600
+STALE_JOB_SEC = 600            # 進捗の更新がこの時間止まった実行中ジョブは失敗扱い
+CLEANUP_INTERVAL_SEC = 60
+FINISHED = ("done", "failed", "cancelled")
+
+class JobCancelled(Exception):
+    pass
+
+class JobQueueFull(Exception):
+    pass
+
+def _pid_alive(pid):
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: return True
+    return True
+
+class JobManager:
+    def __init__(self, job_dir, workers=JOB_WORKERS, max_pending=MAX_PENDING_JOBS, ttl=ARTIFACT_TTL_SEC):
+        self.job_dir = Path(job_dir)
+        self.job_dir.mkdir(parents=True, exist_ok=True)
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_cleanup = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export-job")
+        self._conn = sqlite3.connect(self.job_dir / "jobs.db", timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 1,
+            filename TEXT,
+            mimetype TEXT,
+            artifact TEXT,
+            error TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            pid INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            finished_at REAL
+        )""")
+        self.cleanup(force=True)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _row(self, job_id, owner):
+        rows = self._execute("SELECT * FROM jobs WHERE id = ? AND owner = ?", (job_id, owner))
+        return dict(rows[0]) if rows else None
+
+    @staticmethod
+    def describe(job):
+        """API で返すジョブ情報"""
+        info = {k: job[k] for k in ("id", "kind", "status", "done", "total", "filename", "error", "created_at", "finished_at")}
+        info["download_url"] = f"/jobs/{job['id']}/download" if job["status"] == "done" else None
+        return info
+
+    # --- 登録と実行 ---
+    def submit(self, owner, kind, build, filename, mimetype, total=1):
+        """build(progress) を実行するジョブを登録する。build は成果物のバイト列を返し、
+        progress(done, total) で進捗を報告する (キャンセルされていれば JobCancelled を送出)"""
+        self.cleanup()
+        with self._lock:
+            if self._pending >= self.max_pending: raise JobQueueFull(f"出力ジョブが混み合っています ({self._pending} 件)")
+            self._pending += 1
+        job_id, now = uuid.uuid4().hex, time.time()
+        self._execute("""INSERT INTO jobs(id, owner, kind, status, total, filename, mimetype, pid, created_at, updated_at)
+            VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?, ?)""", (job_id, owner, kind, total, filename, mimetype, os.getpid(), now, now))
+        self._executor.submit(self._run, job_id, build)
+        return self.describe(self._row(job_id, owner))
+
+    def _progress(self, job_id):
+        def report(done, total=None):
+            rows = self._execute("""UPDATE jobs SET done = ?, total = COALESCE(?, total), updated_at = ?
+                WHERE id = ? RETURNING cancel_requested""", (done, total, time.time(), job_id))
+            if not rows or rows[0][0]: raise JobCancelled()
+        return report
+
+    def _finish(self, job_id, status, artifact=None, error=None):
+        now = time.time()
+        self._execute("UPDATE jobs SET status = ?, artifact = ?, error = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+                      (status, artifact, error, now, now, job_id))
+
+    def _run(self, job_id, build):
+        try:
+            rows = self._execute("""UPDATE jobs SET status = 'running', updated_at = ?
+                WHERE id = ? AND status = 'queued' AND cancel_requested = 0 RETURNING kind""", (time.time(), job_id))
+            if not rows: return  # 開始前にキャンセル済み
+            kind, t0 = rows[0][0], time.perf_counter()
+            data = build(self._progress(job_id))
+            path = self.job_dir / f"{job_id}.bin"
+            tmp = path.with_suffix(".tmp")
+            tmp.write_bytes(data); os.replace(tmp, path)
+            self._finish(job_id, "done", artifact=path.name)
+            logging.info(f"Export job {job_id} ({kind}) done: {len(data)} bytes in {time.perf_counter() - t0:.2f} s")
+        except JobCancelled:
+            self._finish(job_id, "cancelled")
+            logging.info(f"Export job {job_id} cancelled")
+        except Exception as e:
+            self._finish(job_id, "failed", error=str(e))
+            logging.error(f"Export job {job_id} failed: {e}")
+        finally:
+            with self._lock: self._pending -= 1
+
+    # --- 参照・キャンセル ---
+    def get(self, job_id, owner):
+        self.cleanup()
+        job = self._row(job_id, owner)
+        return self.describe(job) if job else None
+
+    def cancel(self, job_id, owner):
+        """待機中・実行中のジョブはキャンセルし、終了済みのジョブは成果物ごと削除する"""
+        job = self._row(job_id, owner)
+        if job is None: return None
+        if job["status"] in FINISHED:
+            self._delete(job)
+            return {**self.describe(job), "deleted": True}
+        now = time.time()
+        self._execute("UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ?", (now, job_id))
+        # 開始前なら実行を待たずにキャンセル済みにする (実行中は次の進捗報告で中断される)
+        self._execute("""UPDATE jobs SET status = 'cancelled', updated_at = ?, finished_at = ?
+            WHERE id = ? AND status = 'queued'""", (now, now, job_id))
+        return self.describe(self._row(job_id, owner))
+
+    def artifact(self, job_id, owner):
+        """完了したジョブの (成果物のパス, ファイル名, MIMEタイプ)。未完了・期限切れは None"""
+        job = self._row(job_id, owner)
+        if job is None or job["status"] != "done": return None
+        path = self.job_dir / job["artifact"]
+        return (path, job["filename"], job["mimetype"]) if path.exists() else None
+
+    # --- 片付け ---
+    def _delete(self, job):
+        if job["artifact"]: (self.job_dir / job["artifact"]).unlink(missing_ok=True)
+        self._execute("DELETE FROM jobs WHERE id = ?", (job["id"],))
+
+    def cleanup(self, force=False):
+        """期限切れのジョブと成果物を削除し、実行していたプロセスが終了した・更新が止まったジョブを失敗にする"""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_cleanup < CLEANUP_INTERVAL_SEC: return
+            self._last_cleanup = now
+        for job in self._execute("SELECT * FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (now - self.ttl,)):
+            self._delete(job)
+        for job in self._execute("SELECT * FROM jobs WHERE status IN ('queued', 'running')"):
+            if not _pid_alive(job["pid"]) or (job["status"] == "running" and now - job["updated_at"] > STALE_JOB_SEC):
+                self._finish(job["id"], "failed", error="ジョブを実行していたプロセスが終了しました")
+        for tmp in self.job_dir.glob("*.tmp"):
+            if now - tmp.stat().st_mtime > STALE_JOB_SEC: tmp.unlink(missing_ok=True)
@@ -0,0 +1,86 @@
+import numpy as np
+from wsm_export import CHANNELS, availability_matrix, guard_band_edges, tv_channel_arrays
+
+# --- 相互変調 (IMD) を避けたワイヤレスマイクの周波数プラン ---
+# 施設の運用可能CH (GB 調整後の範囲) と機器の対応範囲・ステップから候補周波数のグリッドを作り、
+# 低い周波数から順に「既存キャリア・既存の IMD 積と衝突しない」最初の候補を採用していく (first-fit)。
+# 採用のたびに、新しいキャリアが関わる IMD 積の位置をまとめて NumPy で計算し、
+# 候補グリッド上の近傍を使用不可としてマークします。周波数の単位はすべて kHz です。
+#
+# 3次: 2a-b, a+b-c   5次 (任意): 3a-2b
+# 候補 f が使用不可になる条件は、既存キャリア集合 S (a, b, c ∈ S) に対して
+#   3次: f ≈ 2a-b, f ≈ (a+b)/2, f ≈ a+b-c
+#   5次: f ≈ 3a-2b, f ≈ (2a+b)/3, f ≈ (3a-b)/2
+# (f 自身が IMD 積に当たる場合と、f が関わる IMD 積が既存キャリアに当たる場合の両方)
+
+DEFAULT_MAX_CARRIERS = 100
+DEFAULT_SPACING_KHZ = 400       # キャリア同士の最小間隔
+DEFAULT_IMD3_SPACING_KHZ = 100  # キャリアと3次 IMD 積の最小間隔
+DEFAULT_IMD5_SPACING_KHZ = 50   # キャリアと5次 IMD 積の最小間隔
+
+def free_windows(min_f, max_f, available):
+    """GB 調整後の各CHの範囲のうち、運用可能なCHを連結した (下限, 上限) のリスト"""
+    windows = []
+    for lo, hi, ok in zip(np.asarray(min_f).tolist(), np.asarray(max_f).tolist(), np.asarray(available).tolist()):
+        if not ok: continue
+        if windows and lo <= windows[-1][1]: windows[-1][1] = max(windows[-1][1], hi)
+        else: windows.append([lo, hi])
+    return [tuple(w) for w in windows]
+
+def candidate_grid(windows, dev_min, dev_max, step):
+    """機器のステップ (dev_min 起点) に乗り、いずれかの窓に含まれる候補周波数 (昇順)"""
+    parts = []
+    for lo, hi in windows:
+        lo, hi = max(lo, dev_min), min(hi, dev_max)
+        if lo > hi: continue
+        start = dev_min + -(-(lo - dev_min) // step) * step
+        parts.append(np.arange(start, hi + 1, step, dtype=np.int64))
+    return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+def _forbidden_by(c, S, fifth_order):
+    """既存キャリア S にキャリア c を加えたときに新たに使用不可となる位置 (3次, 5次)"""
+    if len(S) == 0: return np.empty(0), np.empty(0)
+    imd3 = [2 * c - S, 2 * S - c, (S + c) / 2]
+    if len(S) > 1:
+        A, B = S[:, None], S[None, :]
+        off_diag = ~np.eye(len(S), dtype=bool)
+        imd3 += [(A + B - c)[np.triu(off_diag)], (c + A - B)[off_diag]]
+    imd5 = [3 * c - 2 * S, 3 * S - 2 * c, (2 * S + c) / 3, (2 * c + S) / 3, (3 * S - c) / 2, (3 * c - S) / 2] if fifth_order else []
+    return np.concatenate(imd3), (np.concatenate(imd5) if imd5 else np.empty(0))
+
+def _mark(grid, blocked, values, tol):
+    """values の各位置から tol 未満の距離にある候補を使用不可にする"""
+    if len(values) == 0: return
+    lo = np.searchsorted(grid, values - tol, side='right')
+    hi = np.searchsorted(grid, values + tol, side='left')
+    diff = np.zeros(len(grid) + 1, dtype=np.int64)
+    np.add.at(diff, lo, 1); np.add.at(diff, hi, -1)
+    blocked |= np.cumsum(diff[:-1]) > 0
+
+def plan_carriers(grid, max_carriers=DEFAULT_MAX_CARRIERS, spacing=DEFAULT_SPACING_KHZ,
+                  imd3_spacing=DEFAULT_IMD3_SPACING_KHZ, fifth_order=False, imd5_spacing=DEFAULT_IMD5_SPACING_KHZ):
+    """候補グリッドから IMD と衝突しないキャリアを低い順に選ぶ。戻り値は採用した周波数 (kHz) のリスト"""
+    grid = np.asarray(grid, dtype=np.int64)
+    blocked = np.zeros(len(grid), dtype=bool)
+    carriers = []
+    while len(carriers) < max_carriers:
+        free = np.flatnonzero(~blocked)
+        if len(free) == 0: break
+        c = int(grid[free[0]])
+        imd3, imd5 = _forbidden_by(c, np.array(carriers, dtype=np.float64), fifth_order)
+        carriers.append(c)
+        _mark(grid, blocked, np.array([c], dtype=np.float64), spacing)
+        _mark(grid, blocked, imd3, imd3_spacing)
+        _mark(grid, blocked, imd5, imd5_spacing)
+    return carriers
+
+def plan_for_venue(venue, device, tv_ch_map, selected_channels=None, **options):
+    """施設の運用可能CH (selected_channels 指定時はその中だけ) と機器 (devices の1行) からキャリアを計算"""
+    tv_min, tv_max, present = tv_channel_arrays(tv_ch_map)
+    avail = availability_matrix([venue])
+    min_f, max_f = guard_band_edges(avail, tv_min, tv_max)
+    usable = avail[0] & present
+    if selected_channels: usable &= np.isin(CHANNELS, [int(c) for c in selected_channels])
+    windows = free_windows(min_f[0], max_f[0], usable)
+    grid = candidate_grid(windows, int(device["minfrequency"]), int(device["maxfrequency"]), int(device["STEP"]))
+    return plan_carriers(grid, **options)
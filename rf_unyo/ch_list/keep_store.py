@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from db import file_generation
+
+# --- キープリストのサーバー側保存 ---
+# Cookie セッションには施設データを入れず、リストID (session["keep_id"]) のみを保持します。
+# キープ内容は別ファイルの SQLite (keep_items) に「リストID・施設ID・並び順」で保存し、
+# 施設の詳細は施設DBを読み取り専用で ATTACH して venues との1回の JOIN で取り出します。
+# 施設DBが差し替えられた (inode が変わった) 場合は ATTACH し直します。
+# 施設IDは施設名などのキー列から決まるため (db_builder.assign_venue_ids)、施設リスト側で施設名が変わった施設は
+# 別の施設として扱われ、キープリストからは消えます。件数も venues に存在する施設だけを数えます。
+
+KEEP_EXPIRE_DAYS = 30
+
+class KeepStore:
+    def __init__(self, store_path, venue_db_path):
+        self.store_path = Path(store_path)
+        self.venue_db_path = Path(venue_db_path)
+        self.store_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.store_path.as_uri(), uri=True, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        # ヘッドレスモードでは複数のワーカープロセスが同じファイルを使うため、読み取りが書き込みを待たない WAL にする
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS keep_items (
+            list_id TEXT NOT NULL,
+            venue_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (list_id, venue_id)
+        ) WITHOUT ROWID""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_keep_items_order ON keep_items(list_id, position)")
+        self._venue_generation = None
+        self.purge_expired()
+
+    def _attach_venue_db(self):
+        """施設DBを ATTACH する (差し替え後は新しいファイルを ATTACH し直す)。ロック内で呼ぶこと"""
+        generation = file_generation(self.venue_db_path)
+        if generation == self._venue_generation: return
+        if self._venue_generation is not None: self._conn.execute("DETACH DATABASE venue_db")
+        self._conn.execute("ATTACH DATABASE ? AS venue_db", (self.venue_db_path.as_uri() + "?mode=ro",))
+        self._venue_generation = generation
+
+    def purge_expired(self, days=KEEP_EXPIRE_DAYS):
+        """最終更新から一定期間経過したリストを削除"""
+        with self._lock, self._conn:
+            self._conn.execute("""DELETE FROM keep_items WHERE list_id IN (
+                SELECT list_id FROM keep_items GROUP BY list_id HAVING MAX(updated_at) < ?)""",
+                (time.time() - days * 86400,))
+
+    def _count(self, list_id):
+        """venues に存在する施設の件数 (venues() で返る件数と同じ)。ロック内で呼ぶこと"""
+        self._attach_venue_db()
+        return self._conn.execute("""SELECT COUNT(*) FROM keep_items k JOIN venue_db.venues v ON v.rowid = k.venue_id
+            WHERE k.list_id = ?""", (list_id,)).fetchone()[0]
+
+    def add(self, list_id, venue_id):
+        """末尾に追加 (既にあれば何もしない)。戻り値はリストの件数、venues に無い施設IDなら None"""
+        with self._lock, self._conn:
+            self._attach_venue_db()
+            if not self._conn.execute("SELECT 1 FROM venue_db.venues WHERE rowid = ?", (venue_id,)).fetchone(): return None
+            self._conn.execute("""INSERT OR IGNORE INTO keep_items(list_id, venue_id, position, updated_at)
+                VALUES (?, ?, (SELECT COALESCE(MAX(position), 0) + 1 FROM keep_items WHERE list_id = ?), ?)""",
+                (list_id, venue_id, list_id, time.time()))
+            return self._count(list_id)
+
+    def remove(self, list_id, venue_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM keep_items WHERE list_id = ? AND venue_id = ?", (list_id, venue_id))
+            return self._count(list_id)
+
+    def reorder(self, list_id, venue_ids):
+        """ドラッグ＆ドロップ後の並び順を保存 (venue_ids の順に position を振り直す)"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE keep_items SET position = ?, updated_at = ? WHERE list_id = ? AND venue_id = ?",
+                                   [(i, now, list_id, vid) for i, vid in enumerate(venue_ids, 1)])
+
+    def venues(self, list_id):
+        """キープ中の施設を並び順どおりに venues の全列付きで返す"""
+        with self._lock:
+            self._attach_venue_db()
+            rows = self._conn.execute("""SELECT v.* FROM keep_items k
+                JOIN venue_db.venues v ON v.rowid = k.venue_id
+                WHERE k.list_id = ? ORDER BY k.position""", (list_id,)).fetchall()
+        return [dict(r) for r in rows]
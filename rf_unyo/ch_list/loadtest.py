@@ -0,0 +1,174 @@
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.cookies import SimpleCookie
+from pathlib import Path
+from urllib.parse import urlencode
+from benchmark import SEARCH_MIX, summarize
+
+# --- ヘッドレスモードの負荷試験 ---
+# app.py --headless をワーカー数を変えて起動し、複数のクライアントスレッドから /search・/adjustment・
+# /get_settings を一定時間送り続けて、ワーカー数ごとのスループットとレイテンシを比較します。
+#
+#   python loadtest.py                                   # workers 1,2,4 / 同時接続 16 / 各10秒
+#   python loadtest.py --workers 1,2,4,8 --clients 32 --duration 20 --output load.json
+#   python loadtest.py --db /tmp/rf_unyo_bench/venues_133300.db   # benchmark.py の合成DBを使う
+#   python loadtest.py --write-every 50                  # 50件に1回 /save_settings を混ぜる
+#
+# 施設DB・キープリストはこの試験用の一時コピーを使い、元のファイルには書き込みません
+# (RF_UNYO_DB_PATH / RF_UNYO_KEEP_DB_PATH)。
+# クライアントはそれぞれ自分のセッション Cookie を持ち、開始時に KEEP_VENUES 件をキープしてから
+# 送り始めるため、/adjustment はキープリストのある状態の画面を描画します。
+# ワーカー数を増やしてスループットが伸びるのは CPU コアが複数ある場合のみです (結果の cpu_count を確認してください)。
+
+BASE_DIR = Path(__file__).resolve().parent
+DEFAULT_WORKERS = "1,2,4"
+STARTUP_TIMEOUT_SEC = 60
+# クライアントごとにキープする施設数 (/adjustment の描画対象)
+KEEP_VENUES = 5
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_until_ready(port, proc):
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SEC
+    while time.monotonic() < deadline:
+        if proc.poll() is not None: raise RuntimeError(f"サーバーが終了しました (exit {proc.returncode})")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/metrics"); conn.getresponse().read(); conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("サーバーの起動がタイムアウトしました")
+
+def start_server(port, workers, threads, env):
+    cmd = [sys.executable, str(BASE_DIR / "app.py"), "--headless", "--port", str(port),
+           "--workers", str(workers), "--threads", str(threads)]
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_ready(port, proc)
+    except Exception:
+        proc.kill(); raise
+    return proc
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGTERM)
+    try: proc.wait(timeout=20)
+    except subprocess.TimeoutExpired: proc.kill(); proc.wait()
+
+def request_plan():
+    """クライアント1人が繰り返すリクエストの並び (メソッド, パス, 本文)"""
+    plan = [("GET", "/search?" + urlencode(params), None) for _, params in SEARCH_MIX]
+    plan += [("GET", "/adjustment", None), ("GET", "/get_settings", None)]
+    return plan
+
+class Client:
+    """keep-alive 接続とセッション Cookie を持つ1クライアント"""
+    def __init__(self, port):
+        self.port = port
+        self.cookies = SimpleCookie()
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+    def reconnect(self):
+        self.conn.close(); self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+
+    def request(self, method, path, body=None):
+        headers = {"Content-Type": "application/json"}
+        if self.cookies: headers["Cookie"] = "; ".join(f"{k}={m.value}" for k, m in self.cookies.items())
+        self.conn.request(method, path, body=body, headers=headers)
+        resp = self.conn.getresponse(); data = resp.read()
+        for value in resp.headers.get_all("Set-Cookie") or []: self.cookies.load(value)
+        if resp.getheader("Connection", "").lower() == "close": self.reconnect()
+        return resp, data
+
+def client_loop(port, plan, settings, write_every, venue_ids, deadline, offset):
+    """1つの keep-alive 接続で deadline までリクエストを送り続け、(レイテンシ一覧, エラー数) を返す"""
+    samples, errors, n = [], 0, offset
+    client = Client(port)
+    for venue_id in venue_ids:
+        resp, _ = client.request("POST", "/keep", json.dumps({"id": venue_id}).encode("utf-8"))
+        if resp.status != 200: raise RuntimeError(f"キープに失敗しました (HTTP {resp.status})")
+    while time.monotonic() < deadline:
+        if write_every and n % write_every == write_every - 1: method, path, body = "POST", "/save_settings", settings
+        else: method, path, body = plan[n % len(plan)]
+        n += 1
+        t0 = time.perf_counter()
+        try:
+            resp, _ = client.request(method, path, body)
+            samples.append(time.perf_counter() - t0)
+            if resp.status != 200: errors += 1
+        except OSError:
+            errors += 1; client.reconnect()
+    client.conn.close()
+    return samples, errors
+
+def run_load(port, clients, duration, write_every):
+    setup = Client(port)
+    _, data = setup.request("GET", "/get_settings")
+    settings = json.dumps(json.loads(data), ensure_ascii=False).encode("utf-8")  # 現在の値をそのまま書き戻す
+    _, data = setup.request("GET", "/search?" + urlencode({"q": SEARCH_MIX[0][1]["q"], "limit": KEEP_VENUES}))
+    venue_ids = [item["id"] for item in json.loads(data)["items"]]
+    setup.conn.close()
+    plan = request_plan()
+    deadline = time.monotonic() + duration
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda i: client_loop(port, plan, settings, write_every, venue_ids, deadline, i * 7), range(clients)))
+    elapsed = time.perf_counter() - t0
+    samples = [s for r in results for s in r[0]]
+    stat = summarize(samples) if samples else {"count": 0}
+    stat["throughput_rps"] = round(len(samples) / elapsed, 2)  # 同時接続での実測 (summarize の値は直列換算のため置き換える)
+    stat["errors"] = sum(r[1] for r in results)
+    return stat
+
+def main():
+    parser = argparse.ArgumentParser(description="ヘッドレスモードの負荷試験")
+    parser.add_argument("--workers", default=DEFAULT_WORKERS, help="試すワーカー数 (カンマ区切り)")
+    parser.add_argument("--threads", type=int, default=8, help="ワーカーごとのスレッド数")
+    parser.add_argument("--clients", type=int, default=16, help="同時接続数")
+    parser.add_argument("--duration", type=float, default=10.0, help="ワーカー数ごとの計測時間 (秒)")
+    parser.add_argument("--db", type=Path, default=BASE_DIR / "database.db", help="使用する施設DB (一時コピーで試験する。既定: database.db)")
+    parser.add_argument("--write-every", type=int, default=0, help="N件に1回 /save_settings を送る (0: 送らない)")
+    parser.add_argument("--output", type=Path, default=None, help="結果を保存する JSON")
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="rf_unyo_load_"))
+    shutil.copy(args.db, work_dir / "database.db")
+    env = dict(os.environ, RF_UNYO_DB_PATH=str(work_dir / "database.db"), RF_UNYO_KEEP_DB_PATH=str(work_dir / "keep_list.db"))
+    result = {"created_at": datetime.now().isoformat(timespec="seconds"), "threads": args.threads,
+              "clients": args.clients, "duration_sec": args.duration, "write_every": args.write_every,
+              "keep_venues": KEEP_VENUES, "cpu_count": os.cpu_count(), "runs": {}}
+    base = None
+    try:
+        for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+            port = free_port()
+            print(f"workers={workers}: 起動中...", flush=True)
+            proc = start_server(port, workers, args.threads, env)
+            try:
+                stat = result["runs"][str(workers)] = run_load(port, args.clients, args.duration, args.write_every)
+            finally:
+                stop_server(proc)
+            base = base or stat["throughput_rps"]
+            print(f"  {stat['throughput_rps']:>8.1f} req/s (x{stat['throughput_rps'] / base:.2f})  p50 {stat.get('p50_ms', 0):>8.2f} ms"
+                  f"  p95 {stat.get('p95_ms', 0):>8.2f} ms  p99 {stat.get('p99_ms', 0):>8.2f} ms  errors {stat['errors']}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.output:
+        args.output.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"結果を保存しました: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import bisect
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+# --- 実行時メトリクス (/metrics) ---
+# ルートごとのレイテンシのヒストグラム・レスポンスサイズ・ステータス件数と、
+# SQL 文ごとの実行時間を集計します。しきい値を超えた SQL はスロークエリとしてログに出力します。
+# SQL 文はリテラルを ? に置き換えた形で集計します (スロークエリのログにはパラメータ展開後の文を残します)。
+# SQL の実行時間は sqlite3 のトレースコールバック (文の実行開始時に呼ばれる) から、
+# 「次の文の開始」または「接続の返却」までの時間として測ります (行の取り出しを含む)。
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+SLOW_QUERY_MS = 200
+MAX_SQL_KEYS = 200
+SLOW_QUERY_HISTORY = 50
+
+def _compact_sql(sql):
+    return re.sub(r"\s+", " ", sql).strip()[:300]
+
+def _sql_key(sql):
+    """集計用のキー (トレースに渡される SQL はパラメータ展開済みのため、リテラルを ? に戻す)"""
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    return _compact_sql(re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql))
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1; self.total_ms += ms; self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p):
+        """ヒストグラムからの近似値 (該当バケットの上限。最後のバケットは最大値)"""
+        if not self.count: return None
+        rank, seen = p / 100 * self.count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank: return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else round(self.max_ms, 1)
+        return round(self.max_ms, 1)
+
+    def to_dict(self):
+        labels = [f"le_{b}" for b in LATENCY_BUCKETS_MS] + ["le_inf"]
+        return {"count": self.count, "avg_ms": round(self.total_ms / self.count, 2) if self.count else None,
+                "max_ms": round(self.max_ms, 2), "p50_ms": self.percentile(50), "p95_ms": self.percentile(95),
+                "p99_ms": self.percentile(99), "buckets": dict(zip(labels, self.buckets))}
+
+class _SqlTracer:
+    """1つの接続の貸し出し中に実行された SQL 文の時間を測る (trace callback として渡す)"""
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.current = None
+
+    def __call__(self, sql):
+        if sql.startswith("--"): return  # FTS5 等の内部で実行される文 (外側の文の時間に含める)
+        now = time.perf_counter()
+        self._close(now)
+        self.current = (sql, now)
+
+    def _close(self, now):
+        if self.current is None: return
+        sql, started = self.current
+        self.current = None
+        self.metrics.record_sql(sql, (now - started) * 1000)
+
+    def finish(self):
+        self._close(time.perf_counter())
+
+class Metrics:
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS):
+        self.slow_query_ms = slow_query_ms
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._sql = {}
+        self._slow = deque(maxlen=SLOW_QUERY_HISTORY)
+
+    def record_request(self, route, method, status, elapsed_ms, size):
+        with self._lock:
+            r = self._routes.get((method, route))
+            if r is None:
+                r = self._routes[(method, route)] = {"latency": _Histogram(), "status": {}, "bytes_total": 0, "bytes_max": 0}
+            r["latency"].add(elapsed_ms)
+            r["status"][status] = r["status"].get(status, 0) + 1
+            r["bytes_total"] += size; r["bytes_max"] = max(r["bytes_max"], size)
+
+    def sql_tracer(self):
+        return _SqlTracer(self)
+
+    def record_sql(self, sql, elapsed_ms):
+        key = _sql_key(sql)
+        with self._lock:
+            h = self._sql.get(key)
+            if h is None and len(self._sql) < MAX_SQL_KEYS: h = self._sql[key] = _Histogram()
+            if h is not None: h.add(elapsed_ms)
+            if elapsed_ms >= self.slow_query_ms:
+                self._slow.append({"at": time.strftime("%Y-%m-%d %H:%M:%S"), "ms": round(elapsed_ms, 1), "sql": _compact_sql(sql)})
+        if elapsed_ms >= self.slow_query_ms:
+            logging.warning(f"Slow query ({elapsed_ms:.1f} ms): {_compact_sql(sql)}")
+
+    def snapshot(self):
+        with self._lock:
+            routes = [{"method": m, "route": route, "latency": r["latency"].to_dict(), "status": dict(r["status"]),
+                       "bytes_total": r["bytes_total"], "bytes_max": r["bytes_max"],
+                       "bytes_avg": round(r["bytes_total"] / r["latency"].count) if r["latency"].count else 0}
+                      for (m, route), r in sorted(self._routes.items(), key=lambda kv: kv[0][1])]
+            sql = sorted(({"sql": k, **h.to_dict()} for k, h in self._sql.items()), key=lambda x: -x["avg_ms"] * x["count"])
+            for s in sql: del s["buckets"]
+            return {"uptime_sec": round(time.time() - self.started_at, 1), "slow_query_ms": self.slow_query_ms,
+                    "routes": routes, "sql": sql, "slow_queries": list(self._slow)}
@@ -0,0 +1,204 @@
+import math
+import threading
+from collections import OrderedDict
+
+# --- インクリメンタルサーチ用の検索結果キャッシュ ---
+# 画面は入力のたびに /search?q= を呼ぶため、正規化済みの検索語ごとに「一致した全施設」を表示順に並べた
+# (施設ID, ch_mask, 正規化済み施設名, 住所, 都道府県名, トークン数) のリストを LRU で保持します。
+# 入力が伸びた検索語 (キャッシュ済みの語で始まる語) に一致する施設は元の語の一致施設に必ず含まれるため、
+# DB を検索し直さずにキャッシュ済みの候補を部分一致で絞り込み、並べ替えだけをやり直します。
+# 並び順は app.search_venues の SQL と同じです:
+#   - 2文字以下: 施設名 > 住所 > 都道府県名 の一致順、同順位は施設ID順
+#   - 3文字以上: FTS5 の bm25 の昇順、同値は施設ID順
+# bm25 は DB から読み直した場合は SQL の値を使い、絞り込んだ場合はメモリ上で計算します (FTS5 と同じ式・同じ演算順。
+# 全体の行数と平均トークン数は世代ごとに FTS の列から SQL で数える。FTS5 の内部データは読まない)。
+# メモリ上の計算は世代ごとに最初の絞り込みで SQL の値と突き合わせ、一致しなければその世代では絞り込み時も
+# SQL で bm25 を取り直します (FTS 全体を1回検索するため、stats では sql_ranked に数え、hit_rate には含めない)。
+# 各候補の並べ替えキー ((順位, 施設ID) / (bm25, 施設ID)) も保持し、SQL 側と同じキーでキーセット方式のページ送りに使います。
+# 施設DBが差し替えられた (世代が変わった) 場合は全て破棄します。
+#
+# ブラウザ内検索 (index.html) も同じ式を JS で計算するため、snapshot_ranking_matches でスナップショットから
+# 計算した並び順を SQL と突き合わせ、一致しない場合はスナップショットを配信しません (ブラウザは /search を使う)。
+
+BM25_K1, BM25_B = 1.2, 0.75
+MAX_ENTRIES = 256
+# これより多く一致する語 (1文字の検索など) はキャッシュせず、通常の SQL 検索に任せる
+MAX_CANDIDATES = 20000
+MAX_TOTAL_CANDIDATES = 400000
+MAX_TOO_BROAD = 1024
+
+def _occurrences(text, q):
+    """重なりを含めた出現回数 (trigram でのフレーズ一致の件数)"""
+    n, i = 0, text.find(q)
+    while i >= 0:
+        n += 1; i = text.find(q, i + 1)
+    return n
+
+def _self_overlapping(q):
+    """q の先頭と末尾が重なり得るか (重ならなければ str.count と同じ件数になる)"""
+    return any(q[:k] == q[-k:] for k in range(1, len(q)))
+
+def _tokens(text):
+    return max(len(text) - 2, 0)
+
+def _phrase(q):
+    return '"' + q.replace('"', '""') + '"'
+
+def _bm25_sql(weights):
+    return f"bm25(venues_fts, {', '.join(map(repr, weights))})"
+
+def _bm25_keys(q, docs, n_row, avgdl, weights):
+    """q (3文字以上) に一致する文書 [((施設名, 住所, 都道府県名), トークン数), ...] の bm25 (fts5_aux.c と同じ式・同じ演算順)"""
+    n_hit = len(docs)
+    idf = math.log((n_row - n_hit + 0.5) / (n_hit + 0.5))
+    if idf <= 0.0: idf = 1e-6
+    count = _occurrences if _self_overlapping(q) else str.count
+    k1, b = BM25_K1, BM25_B
+    keys = []
+    for texts, tokens in docs:
+        freq = 0.0
+        for text, w in zip(texts, weights):
+            for _ in range(count(text, q)): freq += w
+        keys.append(-1.0 * (idf * ((freq * (k1 + 1.0)) / (freq + k1 * (1 - b + b * tokens / avgdl)))))
+    return keys
+
+class SearchCache:
+    def __init__(self, weights, max_entries=MAX_ENTRIES, max_candidates=MAX_CANDIDATES, max_total=MAX_TOTAL_CANDIDATES):
+        self.weights = weights          # bm25 の列重み (施設名, 住所, 都道府県名)
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self.max_total = max_total
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # 検索語 -> (並べ替えキーのリスト, 表示順の候補リスト)
+        self._total = 0
+        self._too_broad = set()         # 一致件数が max_candidates を超えた語
+        self._generation = None
+        self._corpus = None             # (FTS の行数, 平均トークン数)
+        self._memory_bm25 = None        # メモリ上の bm25 が SQL と一致したか (None: 未確認)
+        self.hits = self.narrowed = self.misses = self.bypassed = self.sql_ranked = 0
+
+    def _reset(self, generation):
+        self._entries.clear(); self._too_broad.clear()
+        self._total = 0; self._generation = generation; self._corpus = self._memory_bm25 = None
+
+    def lookup(self, conn, generation, q):
+        """正規化済みの検索語 q に一致する全施設を (並べ替えキーのリスト, 表示順の [(施設ID, ch_mask, ...), ...]) で返す。
+        一致件数が多すぎる場合は None (呼び出し側で LIMIT 付きの SQL 検索を行う)"""
+        if self.max_entries <= 0: return None
+        with self._lock:
+            if generation != self._generation: self._reset(generation)
+            entry = self._entries.get(q)
+            if entry is not None:
+                self._entries.move_to_end(q); self.hits += 1
+                return entry
+            if q in self._too_broad:
+                self.bypassed += 1
+                return None
+            parent = next((self._entries[q[:n]] for n in range(len(q) - 1, 0, -1) if q[:n] in self._entries), None)
+            if parent is not None: self.narrowed += 1
+        if parent is not None:
+            rows = [r for r in parent[1] if q in r[2] or q in r[3] or q in r[4]]
+            entry = self._rank_narrowed(conn, generation, q, rows)
+        else:
+            rows, scores = self._fetch(conn, q)
+            with self._lock:
+                if rows is None:
+                    self.bypassed += 1
+                    if generation == self._generation and len(self._too_broad) < MAX_TOO_BROAD: self._too_broad.add(q)
+                    return None
+                self.misses += 1
+            if len(q) < 3: entry = self._sorted(rows, lambda r: (0 if q in r[2] else 1 if q in r[3] else 2, r[0]))
+            else: entry = self._sorted(rows, lambda r: (scores[r[0]], r[0]))
+        self._store(generation, q, entry)
+        return entry
+
+    def _fetch(self, conn, q):
+        """DB から q に一致する全施設と (3文字以上なら) 施設ID → bm25 を取り出す (件数が上限を超えたら (None, None))"""
+        if len(q) >= 3:
+            sql = (f"SELECT venues_fts.rowid, v.ch_mask, venues_fts.name, venues_fts.address, venues_fts.pref, {_bm25_sql(self.weights)} "
+                   "FROM venues_fts JOIN venues v ON v.rowid = venues_fts.rowid WHERE venues_fts MATCH ? LIMIT ?")
+            params = (_phrase(q), self.max_candidates + 1)
+        else:
+            like = f"%{q}%"
+            sql = ("SELECT venues_fts.rowid, v.ch_mask, venues_fts.name, venues_fts.address, venues_fts.pref, NULL "
+                   "FROM venues_fts JOIN venues v ON v.rowid = venues_fts.rowid "
+                   "WHERE venues_fts.name LIKE ? OR venues_fts.address LIKE ? OR venues_fts.pref LIKE ? LIMIT ?")
+            params = (like,) * 3 + (self.max_candidates + 1,)
+        fetched = conn.execute(sql, params).fetchall()
+        if len(fetched) > self.max_candidates: return None, None
+        rows = [(r[0], r[1], r[2] or "", r[3] or "", r[4] or "", _tokens(r[2] or "") + _tokens(r[3] or "") + _tokens(r[4] or ""))
+                for r in fetched]
+        return rows, ({r[0]: r[5] for r in fetched} if len(q) >= 3 else None)
+
+    def _load_corpus(self, conn):
+        """bm25 に使う FTS 全体の行数と平均トークン数 (trigram のトークン数は各列の文字数 - 2)"""
+        tokens = " + ".join(f"max(length(coalesce({c}, '')) - 2, 0)" for c in ("name", "address", "pref"))
+        n_row, n_token = conn.execute(f"SELECT count(*), coalesce(sum({tokens}), 0) FROM venues_fts").fetchone()
+        return n_row, n_token / n_row if n_row else 1.0
+
+    def _sql_scores(self, conn, q):
+        return dict(conn.execute(f"SELECT rowid, {_bm25_sql(self.weights)} FROM venues_fts WHERE venues_fts MATCH ?", (_phrase(q),)))
+
+    def _rank_narrowed(self, conn, generation, q, rows):
+        """絞り込んだ候補を並べ替え、(並べ替えキーのリスト, 並べ替えた候補リスト) を返す"""
+        if len(q) < 3:
+            return self._sorted(rows, lambda r: (0 if q in r[2] else 1 if q in r[3] else 2, r[0]))
+        with self._lock: corpus, memory_bm25 = self._corpus, self._memory_bm25
+        if corpus is None: corpus = self._load_corpus(conn)
+        scores = None
+        if memory_bm25 is not False:
+            scores = dict(zip((r[0] for r in rows), _bm25_keys(q, [(r[2:5], r[5]) for r in rows], *corpus, self.weights)))
+            if memory_bm25 is None:
+                # 世代ごとに一度だけ SQL の値と突き合わせる (絞り込み結果の件数・各施設の bm25 が完全に一致すること)
+                memory_bm25 = scores == self._sql_scores(conn, q)
+        if not memory_bm25: scores = self._sql_scores(conn, q)
+        with self._lock:
+            if generation == self._generation:
+                self._corpus, self._memory_bm25 = corpus, memory_bm25
+            if not memory_bm25: self.sql_ranked += 1
+        return self._sorted([r for r in rows if r[0] in scores], lambda r: (scores[r[0]], r[0]))
+
+    @staticmethod
+    def _sorted(rows, key):
+        pairs = sorted(((key(r), r) for r in rows), key=lambda p: p[0])
+        return [k for k, _ in pairs], [r for _, r in pairs]
+
+    def _store(self, generation, q, entry):
+        with self._lock:
+            if generation != self._generation or q in self._entries: return
+            self._entries[q] = entry; self._total += len(entry[1])
+            while len(self._entries) > self.max_entries or (self._total > self.max_total and len(self._entries) > 1):
+                _, old = self._entries.popitem(last=False); self._total -= len(old[1])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.narrowed + self.misses + self.bypassed
+            return {"entries": len(self._entries), "candidates": self._total, "hits": self.hits, "narrowed": self.narrowed,
+                    "misses": self.misses, "bypassed": self.bypassed, "sql_ranked": self.sql_ranked,
+                    "hit_rate": round((self.hits + self.narrowed - self.sql_ranked) / lookups, 3) if lookups else None}
+
+def _snapshot_columns(snapshot):
+    """スナップショットから index.html の loadSnapshot と同じ検索キー・文書長を作る"""
+    cols, keys = snapshot["columns"], snapshot["keys"]
+    with_keys = lambda k, values: [v if v is not None else (values[i] or "") for i, v in enumerate(k)]
+    pref_keys = with_keys(keys["pref"], cols["都道府県名"]["values"])
+    texts = list(zip(with_keys(keys["name"], cols["施設名"]), with_keys(keys["address"], cols["住所"]),
+                     [pref_keys[i] for i in cols["都道府県名"]["codes"]]))
+    tokens = [_tokens(n) + _tokens(a) + _tokens(p) for n, a, p in texts]
+    return texts, tokens, (sum(tokens) / len(texts) if texts else 1.0)
+
+def _snapshot_bm25_order(snapshot, columns, q, weights):
+    """index.html の searchSnapshot と同じ計算で、q (3文字以上) に一致する施設IDを表示順に返す"""
+    texts, tokens, avgdl = columns
+    hits = [i for i, (n, a, p) in enumerate(texts) if q in n or q in a or q in p]
+    key = dict(zip(hits, _bm25_keys(q, [(texts[i], tokens[i]) for i in hits], len(texts), avgdl, weights)))
+    return [snapshot["id"][i] for i in sorted(hits, key=lambda i: (key[i], i))]
+
+def snapshot_ranking_matches(conn, snapshot, weights, queries):
+    """ブラウザ内検索の並び順 (スナップショット + JS の bm25) が、各検索語で SQL の並び順と一致するか"""
+    columns = _snapshot_columns(snapshot)
+    for q in queries:
+        expected = [r[0] for r in conn.execute(
+            f"SELECT rowid FROM venues_fts WHERE venues_fts MATCH ? ORDER BY {_bm25_sql(weights)}, rowid", (_phrase(q),))]
+        if _snapshot_bm25_order(snapshot, columns, q, weights) != expected: return False
+    return True
@@ -0,0 +1,32 @@
+import shutil
+import sys
+from pathlib import Path
+import pytest
+
+# ch_list 直下のモジュールと data_source のスクリプトを import できるようにする
+CH_LIST_DIR = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(CH_LIST_DIR), str(CH_LIST_DIR / "data_source")]
+
+@pytest.fixture
+def venue_db(tmp_path):
+    """同梱の database.db の作業用コピー"""
+    path = tmp_path / "database.db"
+    shutil.copy(CH_LIST_DIR / "database.db", path)
+    return path
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """作業用の施設DB・キープリストで読み込んだ app (セッション中は同じモジュールを使う)"""
+    import os
+    work = tmp_path_factory.mktemp("app")
+    shutil.copy(CH_LIST_DIR / "database.db", work / "database.db")
+    os.environ["RF_UNYO_DB_PATH"] = str(work / "database.db")
+    os.environ["RF_UNYO_KEEP_DB_PATH"] = str(work / "keep_list.db")
+    os.environ["RF_UNYO_JOB_DIR"] = str(work / "export_jobs")
+    import app
+    app.app.testing = True
+    return app
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
@@ -0,0 +1,44 @@
+import sqlite3
+from contextlib import closing
+import time
+from db import ConnectionPool, data_signature, file_generation, file_signature
+from db_builder import bump_data_version
+
+def normalize(text): return text
+
+def test_settings_write_keeps_data_signature(venue_db):
+    pool = ConnectionPool(venue_db, normalize)
+    before, stat = data_signature(venue_db), file_signature(venue_db)
+    time.sleep(0.01)
+    with pool.write() as conn:
+        conn.execute("INSERT OR REPLACE INTO member_info(id, member_name) VALUES (1, 'テスト')")
+    assert file_signature(venue_db) != stat
+    assert data_signature(venue_db) == before
+
+def test_data_signature_changes_with_venue_data(venue_db):
+    before = data_signature(venue_db)
+    with closing(sqlite3.connect(venue_db)) as conn:
+        bump_data_version(conn); conn.commit()
+    after = data_signature(venue_db)
+    assert after != before and after[:2] == file_generation(venue_db)
+
+def test_write_waiting_on_staged_swap_lands_in_new_file(venue_db, monkeypatch):
+    import threading
+    import db_builder
+    pool = ConnectionPool(venue_db, normalize)
+    with pool.write() as conn: conn.execute("INSERT OR REPLACE INTO member_info(id, member_name) VALUES (1, '旧')")
+    locked, copy_settings = threading.Event(), db_builder._copy_settings
+    def slow_copy(src, dst):
+        locked.set(); time.sleep(0.5)  # 差し替え側が排他ロックを持っている間に書き込みを始めさせる
+        copy_settings(src, dst)
+    monkeypatch.setattr(db_builder, "_copy_settings", slow_copy)
+    def swap():
+        with db_builder.staged_database(venue_db): pass
+    swapper = threading.Thread(target=swap); swapper.start()
+    assert locked.wait(5)
+    old_generation = file_generation(venue_db)
+    with pool.write() as conn: conn.execute("INSERT OR REPLACE INTO member_info(id, member_name) VALUES (1, '新')")
+    swapper.join()
+    assert file_generation(venue_db) != old_generation
+    with closing(sqlite3.connect(venue_db)) as conn:
+        assert conn.execute("SELECT member_name FROM member_info WHERE id = 1").fetchone() == ("新",)
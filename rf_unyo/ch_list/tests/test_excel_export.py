@@ -0,0 +1,28 @@
+import io
+import openpyxl
+from excel_export import _PatchedTemplate, _TemplateBook, slot_cells
+from conftest import CH_LIST_DIR
+
+TEMPLATE = (CH_LIST_DIR / "masters" / "master.xlsx").read_bytes()
+
+def items(n):
+    return [{"venue": {"郵便番号": f"100-{i:04d}", "都道府県名": "東京都", "住所": f"千代田区{i}", "屋内外": "屋内",
+                       "施設名": f"施設{i}", "適用エリア": "ホール"}, "selected_channels": [13 + i]} for i in range(n)]
+
+def slot_values(wb, slot):
+    sn, cells = slot_cells(slot, {"venue": {}, "selected_channels": []})
+    return [wb[sn].cell(row=r, column=c).value for (r, c), _ in cells]
+
+def test_reused_template_clears_unfilled_slots():
+    book = _TemplateBook(TEMPLATE)  # 同じスレッドで使い回すブック
+    book.render(items(10), None, None)
+    wb = openpyxl.load_workbook(io.BytesIO(book.render(items(5), None, None)))
+    assert slot_values(wb, 4)[3] == "施設4"
+    for slot in range(5, 10):
+        assert all(v is None for v in slot_values(wb, slot)), slot
+
+def test_patched_template_matches_fresh_render():
+    fresh = openpyxl.load_workbook(io.BytesIO(_TemplateBook(TEMPLATE).render(items(5), None, None)))
+    patched = openpyxl.load_workbook(io.BytesIO(_PatchedTemplate(TEMPLATE).render(items(5), None, None)))
+    for slot in range(12):
+        assert slot_values(patched, slot) == slot_values(fresh, slot)
@@ -0,0 +1,28 @@
+import pytest
+
+UNKNOWN_VENUE = 99999999
+
+@pytest.mark.parametrize("route, payload", [
+    ("/export", {"data": [{"venue_id": 1}]}),
+    ("/export_wsm", {"venue_id": "abc"}),
+    ("/export_wsm_bulk", {"items": [{}]}),
+])
+def test_export_rejects_malformed_payload(client, route, payload):
+    assert client.post(route, json=payload).status_code == 400
+
+@pytest.mark.parametrize("route, payload", [
+    ("/export", {"data": [{"venue_id": UNKNOWN_VENUE, "selected_channels": []}]}),
+    ("/export_wsm", {"venue_id": UNKNOWN_VENUE}),
+])
+def test_export_unknown_venue_is_404(client, route, payload):
+    assert client.post(route, json=payload).status_code == 404
+
+@pytest.mark.parametrize("job_type, payload, status", [
+    ("export", {"data": [{"venue_id": 1}]}, 400),
+    ("export_wsm_bulk", {"items": [{}]}, 400),
+    ("export", {"data": [{"venue_id": UNKNOWN_VENUE, "selected_channels": []}]}, 404),
+    ("export_wsm", {"venue_id": UNKNOWN_VENUE}, 404),
+])
+def test_job_submission_errors(client, job_type, payload, status):
+    response = client.post("/jobs", json={"type": job_type, "payload": payload})
+    assert response.status_code == status, response.get_json()
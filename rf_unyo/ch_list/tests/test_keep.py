@@ -0,0 +1,8 @@
+def test_keep_rejects_unknown_venue(app_module, client):
+    with app_module.get_db_connection() as conn:
+        known = conn.execute("SELECT id FROM venues ORDER BY id LIMIT 1").fetchone()[0]
+    assert client.post("/keep", json={"id": known}).get_json()["count"] == 1
+    response = client.post("/keep", json={"id": 123})
+    assert response.status_code == 404
+    assert [v["id"] for v in client.get("/get_keep_list").get_json()] == [known]
+    assert client.post("/keep", json={"id": known}).get_json()["count"] == 1
@@ -0,0 +1,11 @@
+from datetime import datetime, timedelta
+
+def test_prune_old_logs_uses_file_dates(app_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "LOG_DIR", tmp_path)
+    today = datetime(2026, 10, 17)
+    keep_days = app_module.LOG_RETENTION_DAYS
+    names = {f"debug.log.{(today - timedelta(days=d)):%Y-%m-%d}": d <= keep_days for d in (1, keep_days, keep_days + 1, 400)}
+    names.update({"debug.log": True, "debug.log.bak": True})
+    for name in names: (tmp_path / name).write_text("x")
+    app_module.prune_old_logs(today)
+    assert {p.name for p in tmp_path.iterdir()} == {name for name, kept in names.items() if kept}
@@ -0,0 +1,33 @@
+from venue_search import VenueSearchEngine
+
+def test_cursor_from_other_engine_is_rejected(app_module, client, monkeypatch):
+    first = client.get("/search?q=ホール&limit=5").get_json()
+    assert first["next"]
+    assert client.get(f"/search?q=ホール&limit=5&after={first['next']}").status_code == 200
+    monkeypatch.setattr(app_module, "search_engine", VenueSearchEngine(app_module.DB_PATH, app_module.normalize_text))
+    response = client.get(f"/search?q=ホール&limit=5&after={first['next']}")
+    assert response.status_code == 400 and "sqlite" in response.get_json()["error"]
+    memory = client.get("/search?q=ホール&limit=5").get_json()
+    assert client.get(f"/search?q=ホール&limit=5&after={memory['next']}").status_code == 200
+
+def _search_all(client, url):
+    ids, cursor = [], None
+    while True:
+        data = client.get(url + (f"&after={cursor}" if cursor else "")).get_json()
+        ids += [item["id"] for item in data["items"]]
+        cursor = data["next"]
+        if not cursor: return ids
+
+def test_city_search_matches_facet_counts(client):
+    for pref in ("東京都", "北海道"):
+        cities = client.get(f"/facets?pref={pref}").get_json()["cities"]
+        picked = [c for c in cities if c["city"] in ("北区", "港区")] or cities[:3]
+        for c in picked:
+            ids = _search_all(client, f"/search?pref={pref}&city={c['city'] or ''}&limit=100")
+            assert len(ids) == len(set(ids)) == c["venue_count"], (pref, c)
+    assert client.get("/search?city=北区").status_code == 400
+
+def test_other_city_is_searchable(client):
+    # 「(その他)」 (市区町村を判定できなかった施設) は city= (空文字) で指定する
+    others = {c["city"]: c["venue_count"] for c in client.get("/facets?pref=東京都").get_json()["cities"]}.get("", 0)
+    assert len(_search_all(client, "/search?pref=東京都&city=&limit=100")) == others
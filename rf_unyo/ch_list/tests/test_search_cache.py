@@ -0,0 +1,38 @@
+import gzip
+import json
+import sqlite3
+from contextlib import closing
+import search_cache
+from search_cache import SearchCache, snapshot_ranking_matches
+
+WEIGHTS = (10.0, 5.0, 1.0)
+QUERIES = ("ホール", "センター", "市民会館", "東京都", "ーヨー")
+
+def sql_order(conn, q):
+    return conn.execute("SELECT rowid, bm25(venues_fts, 10.0, 5.0, 1.0) FROM venues_fts WHERE venues_fts MATCH ? "
+                        "ORDER BY 2, rowid", ('"' + q + '"',)).fetchall()
+
+def narrow(cache, conn):
+    for q in ("ホ", "ホー", "ホール", "ホールセ", "市民", "市民会", "市民会館"):
+        keys, ranked = cache.lookup(conn, 1, q)
+        if len(q) >= 3:
+            assert [(r[0], k[0]) for k, r in zip(keys, ranked)] == sql_order(conn, q), q
+
+def test_narrowed_queries_rank_in_memory_like_sql(venue_db):
+    cache = SearchCache(WEIGHTS)
+    with closing(sqlite3.connect(venue_db)) as conn: narrow(cache, conn)
+    stats = cache.stats()
+    assert stats["narrowed"] == 5 and stats["sql_ranked"] == 0
+
+def test_narrowed_queries_fall_back_to_sql_bm25(venue_db, monkeypatch):
+    monkeypatch.setattr(search_cache, "BM25_B", 0.5)  # メモリ上の式が SQL とずれた場合
+    cache = SearchCache(WEIGHTS)
+    with closing(sqlite3.connect(venue_db)) as conn: narrow(cache, conn)
+    assert cache.stats()["sql_ranked"] == 4
+
+def test_snapshot_ranking_check(venue_db, monkeypatch):
+    with closing(sqlite3.connect(venue_db)) as conn:
+        snapshot = json.loads(gzip.decompress(conn.execute("SELECT data FROM search_snapshot").fetchone()[0]))
+        assert snapshot_ranking_matches(conn, snapshot, WEIGHTS, QUERIES)
+        monkeypatch.setattr(search_cache, "BM25_B", 0.5)  # ブラウザ側の式が SQL とずれた場合
+        assert not snapshot_ranking_matches(conn, snapshot, WEIGHTS, QUERIES)
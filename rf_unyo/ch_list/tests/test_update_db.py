@@ -0,0 +1,29 @@
+from update_db import build_zip_index, find_zip_code, normalize_address
+
+def baseline_find_zip_code(zip_list, norm_target):
+    """従来の照合: キーの長い順 (同じ長さは CSV 順) に並べたマスターで、住所に含まれる最初のキー"""
+    for addr_key, zip_code in sorted(zip_list, key=lambda x: len(x[0]), reverse=True):
+        if addr_key in norm_target: return zip_code
+    return ""
+
+MASTER = [
+    ("東京都港区", "1050000"), ("東京都港区芝公園", "1050011"), ("東京都港区芝", "1050014"),
+    ("東京都北区", "1140000"), ("東京都北区王子", "1140002"), ("東京都北区王子本町", "1140022"),
+    ("北海道札幌市北区", "0010000"), ("北海道札幌市北区北七条西", "0010007"),
+    ("大阪府大阪市北区", "5300000"), ("大阪府大阪市北区梅田", "5300001"), ("大阪府大阪市北区梅田", "5300099"),
+    ("京都府京都市中京区", "6040000"), ("京都府京都市中京区烏丸", "6048000"), ("京都府京都市中京区御池", "6048001"),
+]
+
+def test_find_zip_code_matches_baseline_substring_search():
+    zip_list = [(normalize_address(addr), zip_code) for addr, zip_code in MASTER]
+    index, max_len = build_zip_index({"key": [k for k, _ in zip_list], "zip": [z for _, z in zip_list]})
+    targets = [
+        "東京都港区芝公園4-2-8", "東京都港区六本木1-1", "東京都北区王子本町1-15-22", "東京都北区赤羽",
+        "北海道札幌市北区北七条西2丁目", "大阪府大阪市北区梅田3-1-1", "大阪府大阪府大阪市北区梅田1",
+        # 先頭に建物名・重複した都道府県名などが付いた住所 (先頭一致では見つからない)
+        "ＡＢＣビル東京都港区芝公園1", "(仮)東京都北区王子1-2", "京都府 京都市中京区烏丸通御池", "京都市中京区烏丸",
+        "東京都港区芝公園 大阪府大阪市北区梅田", "該当なし", "",
+    ]
+    for raw in targets:
+        t = normalize_address(raw)
+        assert find_zip_code(index, max_len, t) == baseline_find_zip_code(zip_list, t), raw
@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from db import data_signature
+
+# --- メモリ常駐型の施設検索エンジン ---
+# venues テーブルを起動時に一度だけ読み込み、正規化済みの施設名・住所・都道府県名から
+# bigram / trigram の転置インデックスを作成します。検索はポスティングリストの積集合で候補を絞り、
+# 部分一致を確認した上で「施設名一致 > 住所一致 > 都道府県名一致」の順に並べて返します。
+# 施設データが更新された場合 (data_signature の変化) は次の検索時に自動で再構築します。
+
+SEARCH_FIELDS = ("施設名", "住所", "都道府県名")
+
+def _ngrams(text, n):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def _contains(posting, doc):
+    i = bisect_left(posting, doc)
+    return i < len(posting) and posting[i] == doc
+
+class _Snapshot:
+    """ある時点のDB内容から作ったインデックス一式 (検索中に差し替わっても参照が壊れないよう不変で扱う)"""
+    def __init__(self, signature, columns, rows, keys, index):
+        self.signature = signature
+        self.columns = columns      # venues の列名 (SELECT * と同じ順序。id 列の無い旧DBでは先頭に rowid を id として追加)
+        self.rows = rows            # 文書番号 -> 行タプル
+        self.keys = keys            # 文書番号 -> (正規化施設名, 正規化住所, 正規化都道府県名)
+        self.index = index          # n-gram -> array('I') (昇順の文書番号)
+
+class VenueSearchEngine:
+    def __init__(self, db_path, normalize):
+        self.db_path = Path(db_path)
+        self.normalize = normalize
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _build(self, signature):
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        try:
+            cur = conn.execute("SELECT rowid, * FROM venues")
+            columns = tuple(d[0] for d in cur.description[1:])
+            data = cur.fetchall()
+        finally:
+            conn.close()
+        has_id = "id" in columns
+        if not has_id: columns = ("id",) + columns
+        field_pos = [columns.index(f) for f in SEARCH_FIELDS]
+        rows, keys, postings = [], [], {}
+        for doc, r in enumerate(data):
+            row = r[1:] if has_id else r
+            key = tuple(self.normalize(row[p]) for p in field_pos)
+            rows.append(row); keys.append(key)
+            grams = set()
+            for text in key:
+                grams |= _ngrams(text, 2); grams |= _ngrams(text, 3)
+            for g in grams:
+                postings.setdefault(g, []).append(doc)
+        index = {g: array('I', docs) for g, docs in postings.items()}
+        logging.info(f"VenueSearchEngine: indexed {len(rows)} venues ({len(index)} n-grams)")
+        return _Snapshot(signature, columns, rows, keys, index)
+
+    def ensure_fresh(self):
+        """施設データが変わっていればインデックスを再構築し、最新のスナップショットを返す"""
+        signature = data_signature(self.db_path)
+        snap = self._snapshot
+        if snap is not None and snap.signature == signature: return snap
+        with self._lock:
+            if self._snapshot is None or self._snapshot.signature != signature:
+                self._snapshot = self._build(signature)
+            return self._snapshot
+
+    def _candidates(self, snap, q):
+        if len(q) < 2: return range(len(snap.rows))
+        grams = _ngrams(q, 3 if len(q) >= 3 else 2)
+        postings = []
+        for g in grams:
+            p = snap.index.get(g)
+            if p is None: return []
+            postings.append(p)
+        postings.sort(key=len)
+        result = postings[0]
+        for p in postings[1:]:
+            if not result: break
+            result = [d for d in result if _contains(p, d)]
+        return result
+
+    def search(self, query, offset=0, limit=100, after=None):
+        """部分一致する施設を関連度順 (一致した列の順位, 施設ID) に返す。
+        戻り値は (総件数, 行dictのリスト, 次ページのカーソル用キー or None)。after には前ページの最後のキーを渡す"""
+        snap = self.ensure_fresh()
+        q = self.normalize(query)
+        if not q: return 0, [], None
+        id_pos = snap.columns.index("id")
+        ranked = []
+        for doc in self._candidates(snap, q):
+            name, addr, pref = snap.keys[doc]
+            if q in name: ranked.append((0, snap.rows[doc][id_pos], doc))
+            elif q in addr: ranked.append((1, snap.rows[doc][id_pos], doc))
+            elif q in pref: ranked.append((2, snap.rows[doc][id_pos], doc))
+        ranked.sort()
+        start = bisect_right(ranked, (after[0], after[1], float("inf"))) if after else 0
+        page = ranked[start + offset:start + offset + limit + 1]
+        more = len(page) > limit; page = page[:limit]
+        return (len(ranked), [dict(zip(snap.columns, snap.rows[doc])) for _, _, doc in page],
+                (page[-1][0], page[-1][1]) if more else None)
@@ -0,0 +1,78 @@
+import csv
+import io
+import re
+import zipfile
+import numpy as np
+
+# --- Sennheiser WSM 用 CSV 生成 ---
+# ガードバンド (GB): 隣接CHと運用可否が異なる境界は「可能側」に 1MHz (1000kHz) 寄せる。
+# 13CH の下限・53CH の上限には適用しない。
+# 複数施設分を「施設 × CH」の運用可否行列として一括で計算します。
+
+CH_MIN, CH_MAX = 13, 53
+CHANNELS = np.arange(CH_MIN, CH_MAX + 1)
+GUARD_BAND_KHZ = 1000
+HEADER = ["name", "type", "frequency", "tolerance", "minfrequency", "maxfrequency", "priority", "squelchlevel"]
+BLOCKED_ROW = ["Blocked", 3, 0, 0, 714000, 798000, 4, 5]
+# 周波数プラン (freq_planner.py) で決めたキャリアは固定周波数 (type 1) として出力する
+CARRIER_TYPE, CARRIER_PRIORITY = 1, 1
+
+def availability_matrix(venues):
+    """施設リストから (施設数, 41) の bool 行列を作る。ch_mask 列があればそれを、無ければ ○ 列を使う"""
+    avail = np.zeros((len(venues), len(CHANNELS)), dtype=bool)
+    for i, v in enumerate(venues):
+        if v.get("ch_mask") is not None:
+            avail[i] = (int(v["ch_mask"]) >> (CHANNELS - CH_MIN)) & 1
+        else:
+            avail[i] = [v.get(f"{ch}CH") == '○' for ch in CHANNELS]
+    return avail
+
+def guard_band_edges(avail, tv_min, tv_max):
+    """運用可否行列と各CHの下限・上限 (kHz) から、GB 調整後の下限・上限行列を返す"""
+    min_f = np.broadcast_to(np.asarray(tv_min, dtype=np.int64), avail.shape).copy()
+    max_f = np.broadcast_to(np.asarray(tv_max, dtype=np.int64), avail.shape).copy()
+    shift = np.where(avail, GUARD_BAND_KHZ, -GUARD_BAND_KHZ)
+    edge = avail[:, 1:] != avail[:, :-1]   # CH j と CH j+1 の運用可否が異なる
+    min_f[:, 1:] += np.where(edge, shift[:, 1:], 0)
+    max_f[:, :-1] -= np.where(edge, shift[:, :-1], 0)
+    return min_f, max_f
+
+def tv_channel_arrays(tv_ch_map):
+    """tv_channels のキャッシュから CH 順の下限・上限配列と、定義の有無マスクを作る"""
+    present = np.array([ch in tv_ch_map for ch in CHANNELS])
+    tv_min = np.array([tv_ch_map[ch]["minfrequency"] if ch in tv_ch_map else 0 for ch in CHANNELS], dtype=np.int64)
+    tv_max = np.array([tv_ch_map[ch]["maxfrequency"] if ch in tv_ch_map else 0 for ch in CHANNELS], dtype=np.int64)
+    return tv_min, tv_max, present
+
+def write_wsm_csv(min_row, max_row, present, selected_channels, carriers=()):
+    """1施設分の CSV テキストを作る (GB 計算済みの行を受け取る)"""
+    output = io.StringIO(); writer = csv.writer(output, lineterminator='\n', delimiter=';')
+    writer.writerow(HEADER)
+    selected = set(selected_channels)
+    for ch, ok, min_f, max_f in zip(CHANNELS.tolist(), present.tolist(), min_row.tolist(), max_row.tolist()):
+        if not ok: continue
+        is_selected = ch in selected
+        writer.writerow([f"TV {ch}", 2 if is_selected else 3, 0, 0, min_f, max_f, 2 if is_selected else 4, 5])
+    for i, freq in enumerate(carriers, 1):
+        writer.writerow([f"Carrier {i:02d}", CARRIER_TYPE, int(freq), 0, 0, 0, CARRIER_PRIORITY, 5])
+    writer.writerow(BLOCKED_ROW)
+    return output.getvalue()
+
+def build_wsm_csvs(venues, selected_channels_list, tv_ch_map, carriers_list=None):
+    """複数施設の CSV テキストをまとめて生成 (carriers_list: 施設ごとのキャリア周波数。省略可)"""
+    tv_min, tv_max, present = tv_channel_arrays(tv_ch_map)
+    min_f, max_f = guard_band_edges(availability_matrix(venues), tv_min, tv_max)
+    carriers_list = carriers_list or [()] * len(venues)
+    return [write_wsm_csv(min_f[i], max_f[i], present, chs, carriers_list[i]) for i, chs in enumerate(selected_channels_list)]
+
+def safe_filename(name):
+    return re.sub(r'[\\/:*?"<>|\s]+', '_', str(name or "")).strip('_') or "venue"
+
+def build_wsm_zip(venues, selected_channels_list, tv_ch_map, date_str):
+    """施設ごとの WSM CSV を ZIP にまとめたバイト列を返す (ファイル名は並び順の連番付き)"""
+    mem = io.BytesIO()
+    with zipfile.ZipFile(mem, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i, (v, text) in enumerate(zip(venues, build_wsm_csvs(venues, selected_channels_list, tv_ch_map)), 1):
+            zf.writestr(f"wsm_{i:02d}_{safe_filename(v.get('施設名'))}_{date_str}.csv", text.encode('utf-8'))
+    mem.seek(0)
+    return mem